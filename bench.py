@@ -0,0 +1,190 @@
+"""
+Benchmarks for the crypto pipeline, run with `python bench.py <name>`
+`startup` checks the time until the login window paints against STARTUP_BUDGET_MS and exits 1 when over it,
+set SDL_VIDEODRIVER=dummy on machines without a display.
+`patch` first checks that a full rewrite and an in place patch apply EDIT_CASES the same way and exits 1 when not,
+`check` runs the round trip checks of every format without timing anything
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from scripts.file_handler import StreamCrypTor, CrypTor, FileInterface, WORKERS
+
+STARTUP_BUDGET_MS = 150 # imports and first paint of the login window, without the interpreter itself
+DEFERRED = 'Crypto', 'tkinter', 'numpy' # load on first use, never before the login window paints
+FIRST_PAINT = f'''
+import sys, time
+start = time.perf_counter()
+import pygame
+from scripts import Login
+Login()
+pygame.display.flip()
+print(time.perf_counter() - start, *[name for name in {DEFERRED!r} if name in sys.modules])
+'''
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def bench_parallel(size_mb:int):
+    """lock/unlock throughput of the chunked container per worker count"""
+    data = os.urandom(size_mb * 1024 * 1024)
+    password = 'bench'
+    kdf_time = timed(CrypTor(b'').pass_to_key, password) # paid once per call, not per chunk
+
+    counts = sorted({count for count in (1, 2, 4, 8, 16, 32) if count < WORKERS} | {WORKERS})
+    print(f'{size_mb} MiB, {WORKERS} cores, kdf {kdf_time*1000:.0f} ms (excluded)')
+    print(f'{"workers":>8} {"lock MB/s":>10} {"unlock MB/s":>12} {"speedup":>8}')
+
+    baseline = None
+    for workers in counts:
+        crypter = StreamCrypTor(workers=workers)
+        locked = io.BytesIO()
+        lock_time = timed(crypter.lock, io.BytesIO(data), locked, password) - kdf_time
+        unlock_time = timed(crypter.unlock, io.BytesIO(locked.getvalue()), io.BytesIO(), password) - kdf_time
+        throughput = size_mb / lock_time, size_mb / unlock_time
+        baseline = baseline or throughput
+        print(f'{workers:>8} {throughput[0]:>10.1f} {throughput[1]:>12.1f} {throughput[0]/baseline[0]:>7.2f}x')
+
+EDIT_CASES = [ # against 40 bytes in 16 byte chunks: overlapping, past the end, across chunks
+    [(10, b'abcdef'), (12, b'x')],
+    [(40, b'abcdef'), (42, b'x')],
+    [(38, b'abcdefgh'), (44, b'xy')],
+    [(15, b'ab'), (16, b'c')],
+    [(40, b'a'), (41, b'b'), (42, b'c' * 20)],
+    [(0, b'z' * 50), (5, b'y')],
+]
+
+def check_edits():
+    """edits through a full rewrite and through an in place patch give the same plaintext, returns the cases that don't"""
+    data = bytes(range(40))
+    crypter = StreamCrypTor(chunk_size=16, kdf={'name': 'pbkdf2-sha256', 'iterations': 1000})
+    failed = []
+    for edits in EDIT_CASES:
+        expected = bytearray(data)
+        for offset, chunk in sorted(edits):
+            expected[offset:offset + len(chunk)] = chunk
+
+        locked = io.BytesIO()
+        crypter.lock(io.BytesIO(data), locked, 'check')
+        rewritten, patched, plain = io.BytesIO(), io.BytesIO(locked.getvalue()), {}
+        crypter.rewrite(io.BytesIO(locked.getvalue()), rewritten, 'check', 'check', edits)
+        crypter.patch(patched, 'check', edits)
+        for name, file in (('rewrite', rewritten), ('patch', patched)):
+            file.seek(0)
+            output = io.BytesIO()
+            crypter.unlock(file, output, 'check')
+            plain[name] = output.getvalue()
+        if plain['rewrite'] != expected or plain['patch'] != expected:
+            failed.append(edits)
+    return failed
+
+def check_roundtrip():
+    """lock and unlock through every format, returns what came back different"""
+    data = os.urandom(300)
+    failed = []
+    if CrypTor(CrypTor(data).lock('test')).unlock('test') != data:
+        failed.append('CrypTor')
+    try:
+        CrypTor(CrypTor(data).lock('test')).unlock('wrong')
+        failed.append('CrypTor accepted a wrong password')
+    except ValueError:
+        pass
+
+    for size in (0, 100, 128, 300):
+        locked, unlocked = io.BytesIO(), io.BytesIO()
+        StreamCrypTor(100).lock(io.BytesIO(data[:size]), locked, 'test')
+        StreamCrypTor().unlock(io.BytesIO(locked.getvalue()), unlocked, 'test')
+        if unlocked.getvalue() != data[:size]:
+            failed.append(f'StreamCrypTor {size} bytes')
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory, 'test.file')
+        path.write_bytes(json.dumps([['', '', '']]).encode())
+        FileInterface(path).lock('test', path.with_suffix('.vault'), content='vault')
+        path.write_bytes(data)
+        FileInterface(path).lock('test')
+        path.unlink()
+        FileInterface(str(path) + '.lock').unlock('test')
+        if path.read_bytes() != data:
+            failed.append('FileInterface lock/unlock')
+        rows = [['name', 'user', 'password']]
+        vault = FileInterface(path.with_suffix('.vault'))
+        vault.update('test', json.dumps(rows).encode())
+        if vault.get_passwords('test') != rows:
+            failed.append('FileInterface update')
+    return failed
+
+def run_checks():
+    failed = check_roundtrip() + check_edits()
+    print('\n'.join(f'failed: {case}' for case in failed) or 'all checks passed')
+    return 1 if failed else 0
+
+def bench_patch(size_mb:int):
+    """in place patch of a few bytes against locking the whole file again, after checking both agree"""
+    if failed := check_edits():
+        print(f'rewrite and patch disagree on {failed}')
+        return 1
+    path = 'bench.lock'
+    with open(path, 'wb') as file:
+        StreamCrypTor().lock(io.BytesIO(os.urandom(size_mb * 1024 * 1024)), file, 'bench')
+    try:
+        kdf_time = timed(CrypTor(b'').pass_to_key, 'bench')
+        full = timed(FileInterface(path).patch, 'bench', [(1000, b'changed')], 'other') - 2 * kdf_time
+        print(f'{size_mb} MiB, kdf {kdf_time*1000:.0f} ms (excluded)')
+        print(f'full rewrite (new key) {full*1000:>8.1f} ms')
+        for count in (1, 10, 100):
+            edits = [(offset * size_mb * 1024 * 1024 // count, b'changed') for offset in range(count)]
+            patch = timed(FileInterface(path).patch, 'other', edits) - kdf_time
+            print(f'patch {count:>3} spots        {patch*1000:>8.1f} ms')
+    finally:
+        os.remove(path)
+
+def bench_startup(runs:int):
+    """median time to the first paint over fresh interpreters, then the slowest imports from -X importtime"""
+    root = Path(__file__).parent
+    times = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', FIRST_PAINT], cwd=root, capture_output=True, text=True, check=True)
+        seconds, *loaded = result.stdout.splitlines()[-1].split() # pygame prints its banner first
+        times.append(float(seconds))
+    median = statistics.median(times) * 1000
+    print(f'first paint {median:.0f} ms (median of {runs}, budget {STARTUP_BUDGET_MS} ms)')
+    if loaded:
+        print(f'loaded before the first paint: {", ".join(loaded)}')
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'from scripts import Login'], cwd=root, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        if len(name) - len(name.lstrip()) <= 3: # top level imports and what they import directly
+            imports.append((int(cumulative), name.strip()))
+    for cumulative, name in sorted(imports, reverse=True)[:8]:
+        print(f'{cumulative/1000:>8.1f} ms  {name}')
+    return 1 if median > STARTUP_BUDGET_MS or loaded else 0
+
+BENCHMARKS = {
+    'parallel': bench_parallel,
+    'patch': bench_patch,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('name', choices=[*BENCHMARKS, 'startup', 'check'])
+    parser.add_argument('--size', type=int, default=64, help='MiB of data to run through')
+    parser.add_argument('--runs', type=int, default=5, help='startup only: fresh interpreters to take the median of')
+    args = parser.parse_args()
+    if args.name == 'startup':
+        sys.exit(bench_startup(args.runs))
+    if args.name == 'check':
+        sys.exit(run_checks())
+    sys.exit(BENCHMARKS[args.name](args.size))
@@ -0,0 +1,232 @@
+"""
+Headless lock/unlock/convert/verify over many files, for scripts and cron. Never imports pygame or tkinter.
+Takes files, globs and directories. Prints one line per file as it finishes and exits with
+the worst per-file status: 0 ok, 1 skipped, 2 failed.
+`tree` locks whole directories incrementally, only files changed since the last run get locked again.
+`rekey` locks .lock and .vault files again with kdf parameters calibrated to --unlock-ms on this machine.
+`agent` keeps one vault unlocked behind a Unix socket, `get` and `search` then look entries up through it.
+"""
+import argparse
+import getpass
+import glob
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from scripts.file_handler import FileInterface, WORKERS, COMPRESSORS, KDF_NAMES, FormatError, calibrate
+from scripts.tree import TreeLocker
+from scripts.agent import VaultAgent, AgentClient, AgentError, SOCKET_ENV
+
+STATUS = {'ok': 0, 'skipped': 1, 'failed': 2}
+
+def lock(path:Path, password:str, args:argparse.Namespace):
+    out = Path(str(path) + '.lock')
+    if out.exists() and not args.force:
+        return 'skipped', f'{out.name} exists'
+    FileInterface(path, workers=args.chunk_workers).lock(password, out, args.compress, kdf=args.kdf)
+    return 'ok', out.name
+
+def unlock(path:Path, password:str, args:argparse.Namespace):
+    out = path.with_suffix('')
+    if out.exists() and not args.force:
+        return 'skipped', f'{out.name} exists'
+    FileInterface(path, workers=args.chunk_workers).unlock(password, out)
+    return 'ok', out.name
+
+def convert(path:Path, password:str, args:argparse.Namespace):
+    """json rows -> <name>.vault, the same check the login screen does"""
+    rows = json.loads(path.read_bytes())
+    if not (isinstance(rows, list) and rows and all(isinstance(row, list) and len(row) == 3 for row in rows)):
+        return 'skipped', 'not a list of [name, username, password] rows'
+    out = path.with_suffix('.vault')
+    if out.exists() and not args.force:
+        return 'skipped', f'{out.name} exists'
+    FileInterface(path, workers=args.chunk_workers).lock(password, out, args.compress, 'vault', args.kdf)
+    return 'ok', f'{out.name}, {len(rows)} rows'
+
+class Sink:
+    def write(self, data:bytes):
+        return len(data)
+
+def verify(path:Path, password:str, args:argparse.Namespace):
+    """decrypts in memory only, a vault also has to hold rows"""
+    file = FileInterface(path, workers=args.chunk_workers)
+    info = FileInterface.detect(path) or {}
+    if info.get('content', 'vault' if path.suffix == '.vault' else 'blob') == 'vault':
+        vault = file.read_vault(password)
+        rows = vault['rows'] if isinstance(vault, dict) else vault
+        return 'ok', f'{len(rows)} rows'
+    file.decrypt_to(password, Sink())
+    return 'ok', 'decrypts'
+
+def rekey(path:Path, password:str, args:argparse.Namespace):
+    """in place, a file already on these parameters is left alone unless forced"""
+    file = FileInterface(path, workers=args.chunk_workers)
+    if file.kdf == args.kdf and not args.force:
+        return 'skipped', 'already on these kdf parameters'
+    file.rekey(password, args.kdf)
+    return 'ok', describe(args.kdf)
+
+COMMANDS = {
+    'lock': (lock, lambda path: path.suffix not in ('.lock', '.vault', '.journal', '.tmp') and not path.name.endswith('.journal.bad')),
+    'unlock': (unlock, lambda path: path.suffix == '.lock'),
+    'convert': (convert, lambda path: path.suffix == '.json'),
+    'verify': (verify, lambda path: path.suffix in ('.lock', '.vault')),
+    'rekey': (rekey, lambda path: path.suffix in ('.lock', '.vault')),
+}
+
+def describe(kdf:dict):
+    return ' '.join(f'{name}={value}' for name, value in kdf.items())
+
+def expand(patterns:list[str], wanted) -> list[Path]:
+    """files named by the patterns, directories are walked and only keep files the command takes"""
+    files:dict[Path, None] = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files.update((path, None) for path in sorted(Path(pattern).rglob('*')) if path.is_file() and wanted(path))
+        else:
+            files.update((Path(path), None) for path in sorted(glob.glob(pattern, recursive=True)) if os.path.isfile(path))
+    return list(files)
+
+def read_password(args:argparse.Namespace):
+    if args.password_file:
+        return Path(args.password_file).read_text().rstrip('\r\n')
+    if os.environ.get(args.password_env):
+        return os.environ[args.password_env]
+    if not sys.stdin.isatty():
+        sys.exit(f'no password, set ${args.password_env} or use --password-file')
+    password = getpass.getpass('password: ')
+    if args.command in ('lock', 'convert', 'tree') and getpass.getpass('again: ') != password:
+        sys.exit('passwords differ')
+    return password
+
+def run(command:str, path:Path, password:str, args:argparse.Namespace):
+    func, wanted = COMMANDS[command]
+    if not wanted(path):
+        return 'skipped', f'not a file {command} takes', 0.0
+    start = time.perf_counter()
+    try:
+        status, message = func(path, password, args)
+    except FormatError as e:
+        status, message = 'failed', str(e)
+    except ValueError as e: # the MAC check and the container parser both raise ValueError
+        status, message = 'failed', f'wrong password or broken file ({e})'
+    except Exception as e:
+        status, message = 'failed', f'{type(e).__name__}: {e}'
+    return status, message, time.perf_counter() - start
+
+def lock_trees(args:argparse.Namespace, password:str):
+    worst = 0
+    for root in args.paths:
+        if not os.path.isdir(root):
+            print(f'skipped {root} -> not a directory', flush=True)
+            worst = max(worst, STATUS['skipped'])
+            continue
+        out_dir = Path(args.out, Path(root).resolve().name) if args.out and len(args.paths) > 1 else args.out
+        def progress(status:str, path:str, error:str):
+            print(f'{status:<9} {Path(root, path)}' + (f' -> {error}' if error else ''), flush=True)
+        try:
+            result = TreeLocker(root, out_dir, args.workers, args.compress, args.kdf).lock(password, progress)
+        except ValueError as e:
+            print(f'failed  {root} -> wrong password for the manifest or broken manifest ({e})', flush=True)
+            worst = max(worst, STATUS['failed'])
+            continue
+        print(f'{root}: ' + ', '.join(f'{len(paths)} {status}' for status, paths in result.items()), file=sys.stderr)
+        worst = max(worst, STATUS['failed'] if result['failed'] else 0)
+    sys.exit(worst)
+
+def run_agent(args:argparse.Namespace, password:str):
+    if len(args.paths) != 1:
+        sys.exit('agent takes exactly one vault')
+    try:
+        agent = VaultAgent(args.paths[0], password, args.socket, args.idle_minutes * 60)
+    except FormatError as e:
+        sys.exit(str(e))
+    except ValueError as e:
+        sys.exit(f'wrong password or broken vault ({e})')
+    pid = os.getpid() if args.foreground else agent.detach()
+    if pid:
+        print(f'{SOCKET_ENV}={agent.socket_path}; export {SOCKET_ENV};', flush=True) # eval-able, like ssh-agent
+        print(f'agent pid {pid}, {len(agent.rows)} rows, stops after {args.idle_minutes} idle minutes', file=sys.stderr)
+        if not args.foreground:
+            return
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0)) # serve() still saves and clears the keys on the way out
+    try:
+        agent.serve()
+    except KeyboardInterrupt:
+        pass
+
+def query_agent(args:argparse.Namespace):
+    """get prints only the password of the best match, for $(python cli.py get github)"""
+    term = ' '.join(args.paths)
+    try:
+        with AgentClient(args.socket) as agent:
+            rows = agent.search(term, 1 if args.command == 'get' else 20)
+            if not rows:
+                sys.exit(f'nothing matches {term!r}')
+            if args.command == 'get':
+                print(agent.get(rows[0][0])[2])
+                return
+            for row, name, username in rows:
+                print(f'{row:>6}  {name}  {username}')
+    except (OSError, AgentError) as e:
+        sys.exit(f'no agent ({e}), start one with: eval $(python cli.py agent <vault>)')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=[*COMMANDS, 'tree', 'agent', 'get', 'search'])
+    parser.add_argument('paths', nargs='+', help='files, globs (** works) or directories, search terms for get and search')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='threads in total, one file at a time per thread, a single file gets them all for its chunks')
+    parser.add_argument('--force', action='store_true', help='overwrite existing output files')
+    parser.add_argument('--compress', choices=COMPRESSORS, help='compress before locking, skipped per file when it doesn\'t help')
+    parser.add_argument('--kdf', choices=KDF_NAMES, help='key derivation for new files (scrypt for rekey), calibrated to --unlock-ms')
+    parser.add_argument('--unlock-ms', type=int, default=500, help='time the kdf should take on this machine')
+    parser.add_argument('--out', help='tree only: mirror the .lock files here instead of next to the originals')
+    parser.add_argument('--password-env', default='VAULT_PASSWORD', help='environment variable holding the password')
+    parser.add_argument('--password-file', help='read the password from the first line of this file')
+    parser.add_argument('--socket', help=f'agent socket, defaults to ${SOCKET_ENV} or a new private one for agent')
+    parser.add_argument('--idle-minutes', type=float, default=15, help='agent only: forget the vault after this long without a request')
+    parser.add_argument('--foreground', action='store_true', help='agent only: serve from this process instead of detaching')
+    args = parser.parse_args()
+    if args.command in ('get', 'search'):
+        return query_agent(args)
+    if args.kdf or args.command == 'rekey':
+        args.kdf = calibrate(args.kdf or 'scrypt', args.unlock_ms / 1000) # once per run, every file gets the same parameters
+        print(f'kdf {describe(args.kdf)}', file=sys.stderr)
+
+    if args.command == 'tree':
+        return lock_trees(args, read_password(args))
+    if args.command == 'agent':
+        return run_agent(args, read_password(args))
+
+    paths = expand(args.paths, COMMANDS[args.command][1])
+    if not paths:
+        sys.exit('no files matched')
+    password = read_password(args)
+    files_at_once = max(1, min(args.workers, len(paths)))
+    args.chunk_workers = max(1, args.workers // files_at_once) # the threads left over go to the chunks of each file
+
+    worst = 0
+    counts = dict.fromkeys(STATUS, 0)
+    width = len(str(len(paths)))
+    with ThreadPoolExecutor(files_at_once) as pool:
+        jobs = {pool.submit(run, args.command, path, password, args): path for path in paths}
+        try:
+            for done, job in enumerate(as_completed(jobs), 1):
+                status, message, seconds = job.result()
+                counts[status] += 1
+                worst = max(worst, STATUS[status])
+                print(f'[{done:>{width}}/{len(paths)}] {status:<7} {jobs[job]} -> {message} ({seconds:.2f}s)', flush=True)
+        except KeyboardInterrupt:
+            pool.shutdown(cancel_futures=True)
+            sys.exit(130)
+
+    print(', '.join(f'{count} {status}' for status, count in counts.items()), file=sys.stderr)
+    sys.exit(worst)
+
+if __name__ == '__main__':
+    main()
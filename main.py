@@ -2,19 +2,26 @@
 
 import pygame
 from scripts import Login
+from scripts.const import Misc
 
 def main():
     screen = Login()
     clock = pygame.Clock()
+    pygame.display.flip()
 
     while True:
-        for event in pygame.event.get():
+        if screen.is_animating():
+            events = pygame.event.get()
+            clock.tick(Misc.fps)
+        else: # nothing moves, sleep until the user does something
+            events = [pygame.event.wait()] + pygame.event.get()
+
+        for event in events:
             if (new_screen := screen.handle_event(event)):
                 screen = new_screen
 
-        screen.update()
-        pygame.display.flip()
-        clock.tick()
+        if (rects := screen.update()):
+            pygame.display.update(rects)
 
 if __name__ == '__main__':
     main()
@@ -1 +1,6 @@
-from .screen_manager import Login
\ No newline at end of file
+def __getattr__(name:str):
+    # the gui pulls in pygame and tkinter, only load it when asked for, so the cli and file_handler stay headless
+    if name == 'Login':
+        from .screen_manager import Login
+        return Login
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
@@ -0,0 +1,216 @@
+import os
+import json
+import socket
+import struct
+import tempfile
+import threading
+import time
+import socketserver
+from pathlib import Path
+
+from .file_handler import FileInterface, KeyCache, BackgroundSaver
+from .store import ColumnStore
+from .search import SearchIndex
+
+SOCKET_ENV = 'VAULT_AGENT_SOCK' # like SSH_AUTH_SOCK, tells clients where the agent listens
+IDLE_TIMEOUT = 15 * 60 # seconds without a request before the agent forgets the vault
+MAX_REQUEST = 64 * 1024
+
+class AgentError(Exception):
+    pass
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    """one client connection, any number of json requests, one per line, each answered with one json line"""
+    def handle(self):
+        agent:VaultAgent = self.server.agent # type: ignore
+        if not agent.allowed(self.connection):
+            return
+        while line := self.rfile.readline(MAX_REQUEST):
+            try:
+                reply = agent.dispatch(json.loads(line))
+            except Exception as e:
+                reply = {'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+class VaultAgent:
+    """
+    Keeps one vault unlocked for other processes, the way ssh-agent keeps keys. The kdf and decryption
+    run once at start, a lookup after that is a dictionary access and a round trip over a Unix socket.
+    Passwords stay sealed in memory (FieldSealer) and only get opened for a 'get'. The socket lives in
+    a private directory and only processes of the same user get answers. Edits go through a
+    BackgroundSaver like the Manager's, started by serve() so that detach() can fork before any thread runs.
+    After idle_timeout seconds without a request the agent writes what is pending, clears the keys and stops.
+    Requests are {'op': ..., **arguments}: status, search(term, limit), get(row), update(row, values), stop.
+    """
+    def __init__(self, vault_path:Path|str, password:str, socket_path:Path|str|None = None, idle_timeout:float = IDLE_TIMEOUT):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError('the agent needs unix domain sockets')
+        self.vault_path = Path(vault_path)
+        self.keys = KeyCache(password)
+        try:
+            self.fields, rows = FileInterface(self.vault_path, self.keys).get_sealed(password)
+        except Exception:
+            self.keys.clear()
+            raise
+        self.rows = ColumnStore(rows)
+        self.index = SearchIndex(self.rows)
+        self.password = password
+        self.saver:BackgroundSaver|None = None
+        self.lock = threading.Lock() # requests of all clients take turns, each one is microseconds
+        self.idle_timeout = idle_timeout
+        self.last_request = time.monotonic()
+        self.stopped = threading.Event()
+        self.ops = {
+            'status': self.status,
+            'search': self.search,
+            'get': self.get,
+            'update': self.update,
+            'stop': self.request_stop,
+        }
+
+        self.private_dir = None
+        if socket_path is None:
+            self.private_dir = Path(tempfile.mkdtemp(prefix='vault-')) # 0700
+            socket_path = self.private_dir / f'agent.{os.getpid()}'
+        self.socket_path = Path(socket_path)
+        self.server = socketserver.ThreadingUnixStreamServer(str(self.socket_path), AgentHandler)
+        os.chmod(self.socket_path, 0o600)
+        self.server.daemon_threads = True
+        self.server.agent = self # type: ignore
+
+    @staticmethod
+    def allowed(connection:socket.socket):
+        """same user only, where the os tells who is on the other end. Elsewhere the private directory has to do"""
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        _, uid, _ = struct.unpack('3i', connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+        return uid == os.getuid()
+
+    def dispatch(self, request:dict):
+        self.last_request = time.monotonic()
+        op = request.pop('op', None)
+        if op not in self.ops:
+            raise AgentError(f'unknown op {op!r}')
+        with self.lock:
+            return self.ops[op](**request)
+
+    def status(self):
+        return {'vault': str(self.vault_path), 'rows': len(self.rows), 'save': self.saver.state if self.saver else 'saved',
+            'idle': time.monotonic() - self.last_request, 'idle_timeout': self.idle_timeout}
+
+    def search(self, term:str = '', limit:int = 10):
+        """[row, name, username] of the best matches, never passwords"""
+        term = term.lower()
+        rows = self.index.rank(term, limit) if term else range(min(limit, len(self.rows)))
+        return {'rows': [[row, self.rows.get(row, 0), self.rows.get(row, 1)] for row in rows]}
+
+    def get(self, row:int):
+        if not 0 <= row < len(self.rows):
+            raise AgentError(f'no row {row}')
+        name, username, password = self.rows[row]
+        return {'row': row, 'values': [name, username, self.fields.open(password) if password else '']}
+
+    def update(self, row:int, values:list[str]):
+        """replaces a row, row == number of rows adds one"""
+        if not 0 <= row <= len(self.rows) or len(values) != 3:
+            raise AgentError('update takes an existing row (or the next one) and three values')
+        values = [str(value) for value in values]
+        sealed = values[:2] + [self.fields.seal(values[2]) if values[2] else '']
+        if row == len(self.rows):
+            self.rows.append(sealed)
+        else:
+            for column, text in enumerate(sealed):
+                self.rows.set(row, column, text)
+        self.index.update(row, sealed)
+        self.saver.save({row: sealed})
+        return {'row': row}
+
+    def request_stop(self):
+        threading.Thread(target=self.stop).start() # shutdown waits for this request to finish
+        return {'stopping': True}
+
+    def watch(self):
+        while not self.stopped.wait(min(self.idle_timeout, 5)):
+            if time.monotonic() - self.last_request > self.idle_timeout:
+                self.stop()
+
+    def stop(self):
+        if not self.stopped.is_set():
+            self.stopped.set()
+            self.server.shutdown()
+
+    def detach(self) -> int:
+        """
+        Forks into the background like ssh-agent. Returns the agent's pid in the parent, which only has to
+        exit, and 0 in the agent, which runs in its own session with stdin, stdout and stderr on /dev/null,
+        so a $(...) around the command returns right away.
+        """
+        pid = os.fork()
+        if pid:
+            self.server.socket.close() # the agent keeps its own copy
+            self.fields.clear()
+            self.keys.clear()
+            return pid
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        return 0
+
+    def serve(self):
+        """blocks until stopped, idle or interrupted, then saves and forgets everything"""
+        self.saver = BackgroundSaver(self.vault_path, self.password, self.rows, self.keys, fields=self.fields)
+        self.password = ''
+        threading.Thread(target=self.watch, daemon=True).start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopped.set()
+            self.server.server_close()
+            self.saver.close()
+            self.fields.clear()
+            self.keys.clear()
+            self.socket_path.unlink(missing_ok=True)
+            if self.private_dir:
+                self.private_dir.rmdir()
+
+class AgentClient:
+    """connection to a running agent, reused for every request"""
+    def __init__(self, socket_path:Path|str|None = None):
+        socket_path = socket_path or os.environ.get(SOCKET_ENV)
+        if not socket_path:
+            raise OSError(f'${SOCKET_ENV} is not set')
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(str(socket_path))
+        self.file = self.socket.makefile('rwb')
+
+    def request(self, op:str, **arguments):
+        self.file.write(json.dumps({'op': op, **arguments}).encode() + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise AgentError('the agent closed the connection')
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise AgentError(reply['error'])
+        return reply
+
+    def search(self, term:str, limit:int = 10) -> list[list]:
+        return self.request('search', term=term, limit=limit)['rows']
+
+    def get(self, row:int) -> list[str]:
+        return self.request('get', row=row)['values']
+
+    def update(self, row:int, values:list[str]) -> int:
+        return self.request('update', row=row, values=values)['row']
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -2,6 +2,7 @@ from __future__ import annotations
 import sys
 import os
 import pygame
+from functools import cached_property
 
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
@@ -13,10 +14,22 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
-pygame.font.init()
-class Font:
-    small = pygame.Font(resource_path('assets/AgaveNerdFontMono-Regular.ttf'),12)
-    medium = pygame.Font(resource_path('assets/AgaveNerdFontMono-Regular.ttf'),20)
+class Fonts:
+    """opened on first use, so importing const doesn't touch the font files"""
+    @staticmethod
+    def load(size:int):
+        pygame.font.init()
+        return pygame.Font(resource_path('assets/AgaveNerdFontMono-Regular.ttf'), size)
+
+    @cached_property
+    def small(self):
+        return self.load(12)
+
+    @cached_property
+    def medium(self):
+        return self.load(20)
+
+Font = Fonts()
 
 class Size:
     winsize_login = 200, 300
@@ -40,7 +53,11 @@ class Colors:
     table_highlite_colum = pygame.Color('#4b3318')
     table_highlite_word = pygame.Color('#755530')
 
-class Misc:
-    logo = pygame.image.load_sized_svg(resource_path('assets/logo.svg'),(50,50))
-    pepper = b'neaN\xf7\xb8\xf9\xe3M/w\xfd\x86{\xd06\x07\xd2\xb1\xbfD"I\xaf\xd0\xa8\xc5\xc9N\xba~\x88'
-    seperator = b"\xb2]\x0f\xd9?\xbf^aI\xc3kb\x0bm\xa0\xf9\xa1{\x90\xfa\xbd'\xc2\x15\xa5c\x11\xde\xec\xd6\xd7\xaa"
+class Assets:
+    fps = 60 # frame cap while something animates, idle screens only redraw on events
+
+    @cached_property
+    def logo(self):
+        return pygame.image.load_sized_svg(resource_path('assets/logo.svg'),(50,50))
+
+Misc = Assets()
@@ -1,144 +1,996 @@
-from Crypto.Cipher import AES
-from hashlib import pbkdf2_hmac
+from __future__ import annotations
+from hashlib import pbkdf2_hmac, scrypt
+import io
 import os
 import json
+import struct
+import hmac
+import base64
 import secrets
 from pathlib import Path
+from collections import OrderedDict, deque
+from typing import BinaryIO, Callable, Iterable, TYPE_CHECKING
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
+import time
+import itertools
+import zlib
+import lzma
 
 try:
-    from .const import Misc
-    from .twister import MersenneTwister
+    from .store import ColumnStore
 except:
-    from const import Misc
-    from twister import MersenneTwister
+    from store import ColumnStore
 
-PEPPER = Misc.pepper
-SEPERATOR = Misc.seperator
+if TYPE_CHECKING:
+    import numpy as np
+
+# kept here rather than in const, so the crypto side never needs pygame
+PEPPER = b'neaN\xf7\xb8\xf9\xe3M/w\xfd\x86{\xd06\x07\xd2\xb1\xbfD"I\xaf\xd0\xa8\xc5\xc9N\xba~\x88'
+SEPERATOR = b"\xb2]\x0f\xd9?\xbf^aI\xc3kb\x0bm\xa0\xf9\xa1{\x90\xfa\xbd'\xc2\x15\xa5c\x11\xde\xec\xd6\xd7\xaa"
 KEYSIZE = 32
+KDF = {'name': 'pbkdf2-sha256', 'iterations': 100000} # v1 files, v2 headers without one and the default for new files
+KDF_NAMES = 'pbkdf2-sha256', 'scrypt'
+KDF_LIMITS = { # upper bounds for parameters read from a header, which isn't authenticated before the kdf ran
+    'pbkdf2-sha256': {'iterations': 10_000_000},
+    'scrypt': {'n': 1 << 20, 'r': 32, 'p': 16},
+}
+SCRYPT_MAX_MEMORY = 1 << 30 # 128 * r * n bytes
+MAGIC = b'\x89VLT'
+VERSION = 2
+CHUNK_SIZE = 1024 * 1024
+WORKERS = os.cpu_count() or 1 # chunks en/decrypted at once, AES and numpy release the GIL
+NONCE_SIZE = 16
+TAG_SIZE = 16
+JUMBLE_SEED = sum(bytearray(PEPPER))
+VAULT_PADDING = 4096 # vault saves are padded to this, so small edits keep the same length
+COMPRESSORS = { # name -> (compressor, decompressor) factories, both stream
+    'zlib': (zlib.compressobj, zlib.decompressobj),
+    'lzma': (lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+COMPRESSION_SAMPLE = 64 * 1024 # start of a file compressed to decide whether compressing is worth it
+COMPRESSION_RATIO = 0.9 # sample has to shrink below this or the file gets stored as is
+JOURNAL_MAGIC = b'\x89VLJ'
+JOURNAL_LIMIT = 64 * 1024 # journal size that triggers a compaction into the vault
+
+class PermutationCache:
+    """LRU of jumble permutations keyed on (seed, length), limited by the memory the arrays take"""
+    def __init__(self, max_bytes:int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries:OrderedDict[tuple[int,int], 'np.ndarray'] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, seed:int, length:int) -> 'np.ndarray':
+        key = seed, length
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+
+        permutation = load_twister()(seed).permutation(length)
+        permutation.flags.writeable = False
+
+        with self.lock:
+            if permutation.nbytes <= self.max_bytes and key not in self.entries:
+                self.entries[key] = permutation
+                self.used_bytes += permutation.nbytes
+                while self.used_bytes > self.max_bytes:
+                    _, old = self.entries.popitem(last=False)
+                    self.used_bytes -= old.nbytes
+        return permutation
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used_bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.used_bytes}
+
+PERMUTATIONS = PermutationCache()
+
+def load_twister():
+    """brings numpy along, loaded by the first jumble/dejumble (every v1 file and every v2 record) so it stays out of startup"""
+    try:
+        from .twister import MersenneTwister
+    except ImportError:
+        from twister import MersenneTwister
+    return MersenneTwister
+
+def eax(key:bytes, nonce:bytes|None = None):
+    """AES in EAX mode, pycryptodome gets imported by the first call instead of at startup"""
+    from Crypto.Cipher import AES
+    return AES.new(bytes(key), AES.MODE_EAX, nonce=nonce)
 
 def jumble(data:bytes, seed:int):
-    mt = MersenneTwister(seed)
-    indecies = list(range(len(data)))
-    mt.shuffle(indecies)
-    return bytes(data[i] for i in indecies)
+    import numpy as np
+    indecies = PERMUTATIONS.get(seed, len(data))
+    return np.frombuffer(data, np.uint8)[indecies].tobytes()
 
 def dejumble(data:bytes, seed:int):
-    mt = MersenneTwister(seed)
-    indecies = list(range(len(data)))
-    mt.shuffle(indecies)
-    new_data = bytearray(len(data))
-    for i, idx in enumerate(indecies):
-        new_data[idx] = data[i]
-    return bytes(new_data)
+    import numpy as np
+    indecies = PERMUTATIONS.get(seed, len(data))
+    new_data = np.empty(len(data), np.uint8)
+    new_data[indecies] = np.frombuffer(data, np.uint8)
+    return new_data.tobytes()
+
+class FormatError(ValueError):
+    """a file this version won't open, as opposed to a wrong password: not a vault, an unknown kdf or one past KDF_LIMITS"""
+
+def check_kdf(kdf:dict):
+    limits = KDF_LIMITS.get(kdf.get('name'))
+    if limits is None:
+        raise FormatError(f'unsupported kdf {kdf}')
+    for param, limit in limits.items():
+        value = kdf.get(param)
+        if type(value) is not int or not 1 <= value <= limit:
+            raise FormatError(f'kdf {param} {value!r} out of range, at most {limit}')
+    if kdf['name'] == 'scrypt' and 128 * kdf['r'] * kdf['n'] > SCRYPT_MAX_MEMORY:
+        raise FormatError(f'scrypt would need more than {SCRYPT_MAX_MEMORY >> 20} MiB')
+
+def stretch(secret:bytes, salt:bytes, kdf:dict) -> bytes:
+    check_kdf(kdf)
+    if kdf['name'] == 'pbkdf2-sha256':
+        return pbkdf2_hmac('sha256', secret, salt, kdf['iterations'])[:KEYSIZE]
+    memory = 128 * kdf['r'] * (kdf['n'] + kdf['p'] + 2) + 1024 * 1024
+    return scrypt(secret, salt=salt, n=kdf['n'], r=kdf['r'], p=kdf['p'], maxmem=memory, dklen=KEYSIZE)
+
+def calibrate(name:str = 'scrypt', seconds:float = 0.5) -> dict:
+    """kdf parameters that take at most about `seconds` on this machine, never below a floor"""
+    if name == 'pbkdf2-sha256':
+        probe = {'name': name, 'iterations': 20000}
+    elif name == 'scrypt':
+        probe = {'name': name, 'n': 1 << 12, 'r': 8, 'p': 1}
+    else:
+        raise ValueError(f'unsupported kdf {name}')
+    start = time.perf_counter()
+    stretch(b'calibrate', bytes(KEYSIZE), probe)
+    scale = seconds / (time.perf_counter() - start) # both cost linear in iterations / n
+
+    if name == 'pbkdf2-sha256':
+        iterations = max(10000, int(probe['iterations'] * scale) // 1000 * 1000)
+        return {'name': name, 'iterations': min(iterations, KDF_LIMITS[name]['iterations'])}
+    n = 1 << 12
+    while n * 2 <= probe['n'] * scale and n < KDF_LIMITS[name]['n']: # n has to be a power of two, 1 << 20 is 1 GiB of memory
+        n *= 2
+    if n > probe['n']: # large n falls out of the caches and costs more than linear, measure the pick itself
+        start = time.perf_counter()
+        stretch(b'calibrate', bytes(KEYSIZE), {**probe, 'n': n})
+        if time.perf_counter() - start > seconds:
+            n //= 2
+    return {**probe, 'n': n}
 
 class CrypTor:
-    def __init__(self, content:bytes):
+    def __init__(self, content:bytes, derive:Callable|None = None):
         self.content = content
+        self.derive = derive or self.pass_to_key
 
-    def pass_to_key(self, password:str, salt:bytes|None = None):
+    def pass_to_key(self, password:str, salt:bytes|None = None, kdf:dict|None = None):
         if salt is None:
             salt = secrets.token_bytes(KEYSIZE) # this maximum password lenght = 32
         key = password.encode() + PEPPER
-        key = pbkdf2_hmac('sha256', key, salt, 100000)
-        return key[:KEYSIZE], salt
+        key = stretch(key, salt, kdf or KDF)
+        return key, salt
 
     def lock(self, password:str):
-        key, salt = self.pass_to_key(password)
-        cipher = AES.new(key, AES.MODE_EAX)
+        key, salt = self.derive(password)
+        cipher = eax(key)
         nonce = cipher.nonce
         ciphertext, tag = cipher.encrypt_and_digest(self.content)
-        return jumble(SEPERATOR.join([ciphertext, tag, nonce, salt]), sum(bytearray(PEPPER)))
+        return jumble(SEPERATOR.join([ciphertext, tag, nonce, salt]), JUMBLE_SEED)
     
     def unlock(self, password:str):
-        contents = dejumble(self.content, sum(bytearray(PEPPER))).split(bytearray(SEPERATOR))
+        contents = dejumble(self.content, JUMBLE_SEED).split(bytearray(SEPERATOR))
 
         if not len(contents) == 4:
             raise Exception('broken file')
         
         ciphertext, tag, nonce, salt = contents
-        key, _ = self.pass_to_key(password, salt)
-        cipher = AES.new(key, AES.MODE_EAX, nonce=nonce)
+        key, _ = self.derive(password, salt)
+        cipher = eax(key, nonce)
         plaintext = cipher.decrypt(ciphertext)
         cipher.verify(tag)
         return plaintext
         
+class StreamCrypTor:
+    """
+    v2 container: MAGIC, version, header length, json header, then one record per chunk.
+    The header says what the file holds ('vault' or 'blob'), how the key was derived and carries
+    a check value over its own fields, so a wrong password or a tampered header fails right
+    after the kdf, before any record is read. Every record authenticates the whole header too.
+    Every record is jumble(nonce + ciphertext + tag) of at most chunk_size plaintext bytes,
+    authenticated together with the header, its index and whether it is the last one,
+    so records can't be swapped, dropped or cut off without failing verification.
+    Records don't depend on each other, so they are processed on a thread pool.
+    With compression (recorded in the header) the plaintext is compressed as one stream before it
+    gets cut into chunks, files that don't compress are stored as they are.
+    pad_to pads the stored stream with spaces, valid json for a vault and ignored after a compressed stream.
+    progress(stage, done, total) hears about the 'kdf' and every 'encrypt' / 'decrypt' chunk, bytes of
+    the input so far, total is None when the size isn't known. An exception it raises aborts the run.
+    """
+    def __init__(self, chunk_size:int = CHUNK_SIZE, workers:int = WORKERS, derive:Callable|None = None,
+            compression:str|None = None, pad_to:int = 1, content:str = 'blob', kdf:dict|None = None,
+            progress:Callable[[str, int, int|None], None]|None = None):
+        self.chunk_size = chunk_size
+        self.workers = max(1, workers)
+        self.derive = derive or CrypTor(b'').pass_to_key
+        self.compression = compression
+        self.pad_to = pad_to
+        self.content = content
+        self.kdf = kdf or KDF
+        self.progress = progress
+
+    def report(self, stage:str, done:int = 0, total:int|None = None):
+        if self.progress:
+            self.progress(stage, done, total)
+
+    @staticmethod
+    def remaining(src:BinaryIO) -> int|None:
+        """bytes left in a real file, None for anything else"""
+        try:
+            return os.fstat(src.fileno()).st_size - src.tell()
+        except (AttributeError, OSError):
+            return None
+
+    @staticmethod
+    def read_header(src:BinaryIO):
+        prefix = src.read(len(MAGIC) + 3)
+        if len(prefix) < len(MAGIC) + 3 or not prefix.startswith(MAGIC):
+            raise ValueError('not a v2 file')
+        version, length = struct.unpack('>BH', prefix[len(MAGIC):])
+        if version != VERSION:
+            raise ValueError(f'unsupported version {version}')
+        raw = src.read(length)
+        return json.loads(raw), prefix + raw
+
+    @staticmethod
+    def header_check(key:bytes, info:dict):
+        raw = json.dumps({name: value for name, value in info.items() if name != 'check'}).encode()
+        return hmac.new(bytes(key), b'vault header' + raw, 'sha256').hexdigest()[:32]
+
+    def open_key(self, info:dict, password:str):
+        """key for a header, raises before any record is touched if it can't be the right one"""
+        kdf = info.get('kdf', KDF)
+        check_kdf(kdf)
+        self.report('kdf')
+        key, _ = self.derive(password, bytes.fromhex(info['salt']), kdf)
+        if 'check' in info and not hmac.compare_digest(self.header_check(key, info), info['check']):
+            raise ValueError('wrong password or broken header')
+        return key
+
+    @staticmethod
+    def associated_data(header:bytes, index:int, last:bool):
+        return header + struct.pack('>Q?', index, last)
+
+    def chunks(self, src:BinaryIO, size:int):
+        """yields (index, data, last), reading one chunk ahead to know which one is last"""
+        index = 0
+        current = src.read(size)
+        while True:
+            upcoming = src.read(size)
+            yield index, current, not upcoming
+            if not upcoming:
+                return
+            current = upcoming
+            index += 1
+
+    @staticmethod
+    def rechunk(pieces:Iterable[bytes], size:int):
+        """(index, data, last) like chunks(), for a stream of pieces of any length"""
+        index, pending, buffer = 0, None, bytearray()
+        for piece in pieces:
+            buffer += piece
+            while len(buffer) >= size:
+                if pending is not None:
+                    yield index, pending, False
+                    index += 1
+                pending = bytes(buffer[:size])
+                del buffer[:size]
+        if buffer:
+            if pending is not None:
+                yield index, pending, False
+                index += 1
+            pending = bytes(buffer)
+        yield index, pending or b'', True
+
+    def choose_compression(self, sample:bytes):
+        if not self.compression or not sample:
+            return None
+        compressor = COMPRESSORS[self.compression][0]()
+        size = len(compressor.compress(sample) + compressor.flush())
+        return self.compression if size < len(sample) * COMPRESSION_RATIO else None
+
+    @staticmethod
+    def compressed(pieces:Iterable[bytes], method:str):
+        compressor = COMPRESSORS[method][0]()
+        for piece in pieces:
+            yield compressor.compress(piece)
+        yield compressor.flush()
+
+    @staticmethod
+    def decompressed(pieces:Iterable[bytes], method:str):
+        decompressor = COMPRESSORS[method][1]()
+        for piece in pieces: # keeps pulling records after the end, so the padding still gets verified
+            if not decompressor.eof:
+                yield decompressor.decompress(piece)
+        if not decompressor.eof:
+            raise ValueError('broken file')
+
+    @staticmethod
+    def padded(pieces:Iterable[bytes], size:int):
+        length = 0
+        for piece in pieces:
+            length += len(piece)
+            yield piece
+        yield b' ' * (-length % size)
+
+    @staticmethod
+    def edited(pieces:Iterable[bytes], edits:Iterable[tuple[int, bytes]]):
+        """pieces with (offset, data) edits spliced in, an edit past the end extends the stream"""
+        edits = sorted(edits)
+        position = 0
+        for piece in pieces:
+            piece = bytearray(piece)
+            for offset, data in edits:
+                start, end = max(offset, position), min(offset + len(data), position + len(piece))
+                if start < end:
+                    piece[start - position:end - position] = data[start - offset:end - offset]
+            position += len(piece)
+            yield bytes(piece)
+
+        tail = bytearray()
+        for offset, data in edits:
+            start = max(offset, position)
+            if start - position > len(tail):
+                raise ValueError('edit would leave a gap')
+            if offset + len(data) > start:
+                chunk = data[start - offset:]
+                tail[start - position:start - position + len(chunk)] = chunk # grows the tail only past its end
+        yield bytes(tail)
+
+    @staticmethod
+    def seal(key:bytes, header:bytes, index:int, chunk:bytes, last:bool, nonce:bytes):
+        cipher = eax(key, nonce)
+        cipher.update(StreamCrypTor.associated_data(header, index, last))
+        ciphertext, tag = cipher.encrypt_and_digest(chunk)
+        return jumble(nonce + ciphertext + tag, JUMBLE_SEED)
+
+    @staticmethod
+    def unseal(key:bytes, header:bytes, index:int, record:bytes, last:bool):
+        record = dejumble(record, JUMBLE_SEED)
+        cipher = eax(key, record[:NONCE_SIZE])
+        cipher.update(StreamCrypTor.associated_data(header, index, last))
+        return cipher.decrypt_and_verify(record[NONCE_SIZE:-TAG_SIZE], record[-TAG_SIZE:])
+
+    def ordered(self, func:Callable, jobs:Iterable[tuple]):
+        """func(*job) for every job, results in job order, with a bounded number of chunks in memory"""
+        if self.workers == 1:
+            yield from (func(*job) for job in jobs)
+            return
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending = deque()
+            for job in jobs:
+                pending.append(pool.submit(func, *job))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def lock(self, src:BinaryIO, dst:BinaryIO, password:str):
+        total = self.remaining(src)
+        def pieces():
+            done = 0
+            for piece in iter(partial(src.read, self.chunk_size), b''):
+                done += len(piece)
+                self.report('encrypt', done, total)
+                yield piece
+        return self.lock_pieces(pieces(), dst, password)
+
+    def lock_pieces(self, pieces:Iterable[bytes], dst:BinaryIO, password:str):
+        """lock() for plaintext handed over as pieces of any size, returns the number of records"""
+        pieces = iter(pieces)
+        first = next(pieces, b'')
+        compression = self.choose_compression(first[:COMPRESSION_SAMPLE])
+        self.report('kdf')
+        key, salt = self.derive(password, None, self.kdf)
+        info = {'chunk_size': self.chunk_size, 'salt': salt.hex()}
+        if compression:
+            info['compression'] = compression
+        info.update(content=self.content, kdf=self.kdf)
+        info['check'] = self.header_check(key, info)
+        raw = json.dumps(info).encode()
+        header = MAGIC + struct.pack('>BH', VERSION, len(raw)) + raw
+        dst.write(header)
+
+        stream:Iterable[bytes] = itertools.chain([first], pieces)
+        if compression:
+            stream = self.compressed(stream, compression)
+        if self.pad_to > 1:
+            stream = self.padded(stream, self.pad_to)
+        jobs = (
+            (key, header, index, chunk, last, secrets.token_bytes(NONCE_SIZE))
+            for index, chunk, last in self.rechunk(stream, self.chunk_size)
+        )
+        records = 0
+        for record in self.ordered(self.seal, jobs):
+            dst.write(record)
+            records += 1
+        return records
+
+    def plain_pieces(self, src:BinaryIO, password:str):
+        """the verified (and decompressed) plaintext of a container, piece by piece"""
+        info, header = self.read_header(src)
+        key = self.open_key(info, password)
+        record_size = info['chunk_size'] + NONCE_SIZE + TAG_SIZE
+        total = self.remaining(src)
+
+        def jobs():
+            done = 0
+            for index, record, last in self.chunks(src, record_size):
+                if len(record) < NONCE_SIZE + TAG_SIZE or (not last and len(record) != record_size):
+                    raise ValueError('broken file')
+                done += len(record)
+                self.report('decrypt', done, total)
+                yield key, header, index, record, last
+
+        pieces = self.ordered(self.unseal, jobs())
+        if info.get('compression'):
+            pieces = self.decompressed(pieces, info['compression'])
+        yield from pieces
+
+    def unlock(self, src:BinaryIO, dst:BinaryIO, password:str):
+        for piece in self.plain_pieces(src, password):
+            dst.write(piece)
+
+    def rewrite(self, src:BinaryIO, dst:BinaryIO, password:str, new_password:str, edits:Iterable[tuple[int, bytes]] = ()):
+        """full rewrite with edits applied under new_password (and a new salt), without a plaintext file"""
+        return self.lock_pieces(self.edited(self.plain_pieces(src, password), edits), dst, new_password)
+
+    def patch(self, file:BinaryIO, password:str, edits:list[tuple[int, bytes]]):
+        """
+        Applies (offset, data) edits to the plaintext of a locked file opened r+b, in place.
+        Only the records the edits touch get re-sealed (with fresh nonces), so the cost follows the
+        size of the change instead of the file. Edits may grow the file but not leave a gap,
+        shrinking needs a full rewrite. Returns the number of records written.
+        A crash while writing leaves a record that fails verification, not a silently wrong one.
+        """
+        info, header = self.read_header(file)
+        if info.get('compression'):
+            raise ValueError('a compressed container can only be rewritten as a whole')
+        key = self.open_key(info, password)
+        chunk_size = info['chunk_size']
+        record_size = chunk_size + NONCE_SIZE + TAG_SIZE
+        size = file.seek(0, os.SEEK_END) - len(header)
+        records = max(1, -(-size // record_size))
+        old_last = records - 1
+        length = size - records * (NONCE_SIZE + TAG_SIZE)
+
+        touched:set[int] = set()
+        new_length = length
+        for offset, data in sorted(edits):
+            if offset > new_length:
+                raise ValueError('edit would leave a gap')
+            if data:
+                touched.update(range(offset // chunk_size, (offset + len(data) - 1) // chunk_size + 1))
+            new_length = max(new_length, offset + len(data))
+        new_last = max(0, -(-new_length // chunk_size) - 1)
+        if new_last != old_last:
+            touched.add(old_last) # isn't the last record anymore
+        if not touched:
+            return 0
+
+        chunks:dict[int, bytearray] = {}
+        for index in sorted(touched):
+            chunk = bytearray()
+            if index < records:
+                file.seek(len(header) + index * record_size)
+                chunk += self.unseal(key, header, index, file.read(record_size), index == old_last)
+            for offset, data in sorted(edits):
+                start, end = max(offset, index * chunk_size), min(offset + len(data), (index + 1) * chunk_size)
+                if start < end:
+                    chunk[start - index * chunk_size:end - index * chunk_size] = data[start - offset:end - offset]
+            chunks[index] = chunk
+
+        jobs = (
+            (key, header, index, bytes(chunk), index == new_last, secrets.token_bytes(NONCE_SIZE))
+            for index, chunk in chunks.items()
+        )
+        for index, record in zip(chunks, self.ordered(self.seal, jobs)):
+            file.seek(len(header) + index * record_size)
+            file.write(record)
+        return len(chunks)
+
+class KeyCache:
+    """
+    Keys derived during one login session, keyed on (vault path, salt, kdf), so the KDF runs once per session.
+    Re-locking a vault with the same kdf reuses its salt to stay on the cached key, every chunk still gets a fresh nonce.
+    clear() zeroes the keys, call it on logout.
+    """
+    def __init__(self, password:str):
+        self.password = password
+        self.keys:dict[tuple[Path,bytes,str], bytearray] = {}
+        self.salts:dict[tuple[Path,str], bytes] = {}
+        self.lock = threading.Lock()
+
+    def pass_to_key(self, file_path:Path|str, password:str, salt:bytes|None = None, kdf:dict|None = None):
+        if not hmac.compare_digest(password.encode(), self.password.encode()):
+            return CrypTor(b'').pass_to_key(password, salt, kdf) # not this session's password, don't touch the cache
+
+        file_path = Path(file_path).resolve()
+        params = json.dumps(kdf or KDF, sort_keys=True)
+        with self.lock:
+            if salt is None:
+                salt = self.salts.get((file_path, params))
+            if salt is not None and (file_path, salt, params) in self.keys:
+                return self.keys[file_path, salt, params], salt
+
+            key, salt = CrypTor(b'').pass_to_key(password, salt, kdf)
+            self.keys[file_path, salt, params] = bytearray(key)
+            self.salts[file_path, params] = salt
+            return self.keys[file_path, salt, params], salt
+
+    def clear(self):
+        with self.lock:
+            for key in self.keys.values():
+                key[:] = bytes(len(key))
+            self.keys.clear()
+            self.salts.clear()
+            self.password = ''
+
+class FieldSealer:
+    """
+    Seals single vault fields (the passwords), so they stay encrypted in memory until one is needed.
+    A sealed field is base64(nonce + ciphertext + tag). Its key comes from the vault password and
+    the field salt and kdf kept in the vault, which are the vault's own so a KeyCache has the key already.
+    """
+    def __init__(self, password:str, salt:bytes|None = None, derive:Callable|None = None, kdf:dict|None = None):
+        self.kdf = kdf or KDF
+        key, self.salt = (derive or CrypTor(b'').pass_to_key)(password, salt, self.kdf)
+        self.key = bytearray(hmac.new(bytes(key), b'vault fields', 'sha256').digest()) # not the vault key itself
+
+    def seal(self, text:str) -> str:
+        cipher = eax(self.key, secrets.token_bytes(NONCE_SIZE))
+        ciphertext, tag = cipher.encrypt_and_digest(text.encode())
+        return base64.b64encode(cipher.nonce + ciphertext + tag).decode()
+
+    def open(self, sealed:str) -> str:
+        record = base64.b64decode(sealed)
+        cipher = eax(self.key, record[:NONCE_SIZE])
+        return cipher.decrypt_and_verify(record[NONCE_SIZE:-TAG_SIZE], record[-TAG_SIZE:]).decode()
+
+    @staticmethod
+    def length(sealed:str):
+        """utf-8 length of the sealed text, without opening it"""
+        return len(sealed) * 3 // 4 - sealed.count('=') - NONCE_SIZE - TAG_SIZE
+
+    def dumps(self, rows:list[list[str]]):
+        """vault json for rows with sealed passwords"""
+        return json.dumps({'field_salt': self.salt.hex(), 'field_kdf': self.kdf, 'rows': rows}).encode()
+
+    def clear(self):
+        self.key[:] = bytes(len(self.key))
+
 class FileInterface:
-    def __init__(self, file_path:Path|str = Path('password.vault')):
+    def __init__(self, file_path:Path|str = Path('password.vault'), keys:KeyCache|None = None, progress:Callable|None = None, workers:int = WORKERS):
         self.extension = '.lock'
         self.file_path = Path(file_path)
+        self._file_content = None
+        self.derive = partial(keys.pass_to_key, self.file_path) if keys else None
+        self.progress = progress # see StreamCrypTor
+        self.workers = workers # chunk threads of every StreamCrypTor, 1 when the caller already runs files in parallel
 
         with open(self.file_path,'rb') as file:
-            self.file_content = file.read()
+            self.version = VERSION if file.read(len(MAGIC)) == MAGIC else 1
+
+    @property
+    def file_content(self):
+        """whole file, only read for the v1 format which can't be streamed"""
+        if self._file_content is None:
+            with open(self.file_path,'rb') as file:
+                self._file_content = file.read()
+        return self._file_content
+
+    @staticmethod
+    def write_atomic(out_path:Path, write:Callable[[BinaryIO], object]):
+        """write through a temporary file, so a failed run never leaves a half written file behind, returns what write returned"""
+        tmp_path = out_path.with_name(out_path.name + '.tmp')
+        try:
+            with open(tmp_path,'wb') as file:
+                result = write(file)
+            os.replace(tmp_path, out_path)
+            return result
+        finally:
+            if tmp_path.exists():
+                os.remove(tmp_path)
 
-    def lock(self, password:str, out_path:str|Path|None = None):
+    def decrypt_to(self, password:str, dst:BinaryIO):
+        if self.version == 1:
+            if self.progress:
+                self.progress('kdf', 0, None) # v1 is one block, there is nothing to report in between
+            content = dejumble(self.file_content, JUMBLE_SEED)
+            dst.write(CrypTor(content, self.derive).unlock(password))
+        else:
+            with open(self.file_path,'rb') as file:
+                StreamCrypTor(workers=self.workers, derive=self.derive, progress=self.progress).unlock(file, dst, password)
+
+    @property
+    def kdf(self) -> dict:
+        """kdf parameters from the header, v1 files always used the default"""
+        return (self.detect(self.file_path) or {}).get('kdf', KDF)
+
+    @staticmethod
+    def detect(file_path:Path|str) -> dict|None:
+        """header of a v2 container, read from the first few hundred bytes without the kdf. None for anything else"""
+        try:
+            with open(file_path, 'rb') as file:
+                return StreamCrypTor.read_header(file)[0]
+        except (OSError, ValueError):
+            return None
+
+    def lock(self, password:str, out_path:str|Path|None = None, compression:str|None = None, content:str = 'blob', kdf:dict|None = None):
         if out_path is None:
             out_path = str(self.file_path) + self.extension
-        out_path = Path(out_path)
-        self.file_content = CrypTor(self.file_content).lock(password)
-        self.file_content = jumble(self.file_content, sum(bytearray(PEPPER)))
-        with open(out_path,'wb') as file:
-            file.write(self.file_content)
+        crypter = StreamCrypTor(workers=self.workers, derive=self.derive, compression=compression, content=content, kdf=kdf, progress=self.progress)
+        with open(self.file_path,'rb') as src:
+            self.write_atomic(Path(out_path), lambda dst: crypter.lock(src, dst, password))
     
     def unlock(self, password:str, out_path:str|Path|None = None):
         if out_path is None:
             out_path = str(self.file_path).removesuffix(self.extension)
-        out_path = Path(out_path)
-        content = dejumble(self.file_content, sum(bytearray(PEPPER)))
-        plaintext = CrypTor(content).unlock(password)
-        if plaintext:
-            with open(out_path,'wb') as file:
-                file.write(plaintext)
-
-    def update(self, password:str, content:bytes):
-        data = dejumble(self.file_content, sum(bytearray(PEPPER)))
-        if not CrypTor(data).unlock(password): return
-        with open(self.file_path, 'wb') as f:
-            content = CrypTor(content).lock(password)
-            f.write(jumble(content, sum(bytearray(PEPPER))))
+        self.write_atomic(Path(out_path), lambda dst: self.decrypt_to(password, dst))
+
+    def update(self, password:str, content:bytes, new_password:str|None = None, kdf:dict|None = None):
+        """full rewrite of a vault, which also folds its journal in, keeps the vault's kdf unless given a new one"""
+        self.read_vault(password) # raises on a wrong password before anything gets overwritten
+        crypter = StreamCrypTor(workers=self.workers, derive=self.derive, compression='zlib', pad_to=VAULT_PADDING, content='vault',
+            kdf=kdf or self.kdf, progress=self.progress)
+        self.write_atomic(self.file_path, lambda dst: crypter.lock(io.BytesIO(content), dst, new_password or password))
+        self._file_content = None
+        self.version = VERSION
+        Journal(self.file_path).clear()
+
+    def patch(self, password:str, edits:list[tuple[int, bytes]], new_password:str|None = None, kdf:dict|None = None):
+        """
+        Changes parts of a locked file, returns the number of records written. Only the touched records
+        get re-sealed in place (see StreamCrypTor.patch), but a new password or kdf means a new key for every
+        record, and a compressed stream or a v1 file can't be edited in place, those get a full rewrite.
+        Vaults stay on update(), a full atomic rewrite is cheap for them and a torn write can't lose one.
+        """
+        if self.version == 1:
+            plaintext = io.BytesIO()
+            self.decrypt_to(password, plaintext)
+            pieces = StreamCrypTor.edited([plaintext.getvalue()], edits)
+            crypter = StreamCrypTor(workers=self.workers, derive=self.derive, kdf=kdf, progress=self.progress)
+            records = self.write_atomic(self.file_path, lambda dst: crypter.lock_pieces(pieces, dst, new_password or password))
+            self._file_content = None
+            self.version = VERSION
+            return records
+
+        with open(self.file_path, 'rb') as file:
+            info, _ = StreamCrypTor.read_header(file)
+        if new_password not in (None, password) or kdf not in (None, info.get('kdf', KDF)) or info.get('compression'):
+            crypter = StreamCrypTor(info['chunk_size'], self.workers, derive=self.derive, compression=info.get('compression'),
+                content=info.get('content', 'blob'), kdf=kdf or info.get('kdf'), progress=self.progress)
+            def rewrite(dst:BinaryIO):
+                with open(self.file_path, 'rb') as src:
+                    return crypter.rewrite(src, dst, password, new_password or password, edits)
+            return self.write_atomic(self.file_path, rewrite)
+
+        with open(self.file_path, 'r+b') as file:
+            return StreamCrypTor(workers=self.workers, derive=self.derive, progress=self.progress).patch(file, password, edits)
+
+    def rekey(self, password:str, kdf:dict, new_password:str|None = None):
+        """
+        Locks the file again under new kdf parameters (and optionally a new password), in place.
+        A vault also gets its sealed fields moved to the new key, sharing the new vault salt
+        so a login still runs the kdf once.
+        """
+        if (self.detect(self.file_path) or {}).get('content', 'vault' if self.file_path.suffix == '.vault' else 'blob') != 'vault':
+            self.patch(password, [], new_password, kdf)
+            return
+
+        new_password = new_password or password
+        rows = self.get_passwords(password)
+        keys = KeyCache(new_password)
+        target = FileInterface(self.file_path, keys, self.progress, self.workers)
+        try:
+            fields = FieldSealer(new_password, derive=target.derive, kdf=kdf)
+            target.update(password, fields.dumps([row[:2] + [fields.seal(row[2]) if row[2] else ''] for row in rows]), new_password, kdf)
+            fields.clear()
+        finally:
+            keys.clear()
+        self._file_content = None
+        self.version = VERSION
+
+    def append_rows(self, password:str, rows:dict[int, list[str]]):
+        """cheap save of a few edited vault rows, returns the journal size afterwards"""
+        journal = Journal(self.file_path, *self.vault_key(password))
+        journal.append(rows)
+        return journal.size()
+
+    def vault_key(self, password:str) -> tuple[bytes, bytes]:
+        """key and salt of a v2 vault, checked against its header (or its first record, for headers without a check)"""
+        crypter = StreamCrypTor(workers=self.workers, derive=self.derive)
+        with open(self.file_path, 'rb') as file:
+            info, _ = crypter.read_header(file)
+            key = crypter.open_key(info, password)
+            if 'check' not in info:
+                file.seek(0)
+                next(crypter.plain_pieces(file, password), None)
+        return key, bytes.fromhex(info['salt'])
     
+    def read_vault(self, password:str) -> list|dict:
+        """decrypted vault json with the journal replayed, a list of rows or the sealed layout"""
+        if self.version == VERSION and (self.detect(self.file_path) or {}).get('content', 'vault') != 'vault':
+            raise FormatError('not a vault file')
+        data = io.BytesIO()
+        self.decrypt_to(password, data)
+        vault = json.loads(data.getvalue())
+        journal = Journal(self.file_path)
+        if journal.size() and self.version == 1:
+            journal.set_aside() # v1 vaults get converted before their first edit, this one can't be theirs
+        elif journal.size():
+            Journal(self.file_path, *self.vault_key(password)).replay(vault['rows'] if isinstance(vault, dict) else vault)
+        return vault
+
     def get_passwords(self, password:str):
-        data = dejumble(self.file_content, sum(bytearray(PEPPER)))
-        data = CrypTor(data).unlock(password)
-        return json.loads(data)
-
-if __name__ == '__main__': # tests
-    from shutil import copyfile
-    from ntimer import timer
-    @timer
-    def test():
-        file_path = 'test.file'
-        password = 'test'
-        data = os.urandom(128)
-        data2 = os.urandom(128)
-
-        print('testing CrypTor')
-        a = CrypTor(data).lock(password)
-        b = CrypTor(a).unlock(password)
-        assert b == data
-        a = CrypTor(data).lock(password*100)
-        b = CrypTor(a).unlock(password*101)
-        assert b != data
-        a = CrypTor(data).lock(password*100)
-        b = CrypTor(a).unlock(password*100)
-        assert b == data
-
-        print('testing FileInterface')
-        with open(file_path, 'wb') as f:
-            f.write(data)
-        FileInterface(file_path).lock(password)
-        os.remove(file_path)
-        copyfile(file_path+'.lock',file_path+'.vault')
-        FileInterface(file_path+'.lock').unlock(password)
-        os.remove(file_path+'.lock')
-        with open(file_path, 'rb') as f:
-            new_data = f.read()
-        os.remove(file_path)
-        assert new_data == data
-        FileInterface(file_path+'.vault').update(password,data2)
-        FileInterface(file_path+'.vault').unlock(password)
-        with open(file_path+'.vault', 'rb') as f:
-            new_data = f.read()
-        os.remove(file_path+'.vault')
-        assert new_data == data2
-        print('All tests succeded !')
-    test()
\ No newline at end of file
+        """all rows in plaintext"""
+        vault = self.read_vault(password)
+        if isinstance(vault, list):
+            return vault
+        fields = FieldSealer(password, bytes.fromhex(vault['field_salt']), self.derive, vault.get('field_kdf'))
+        return [row[:2] + [fields.open(row[2]) if row[2] else ''] for row in vault['rows']]
+
+    def get_sealed(self, password:str) -> tuple[FieldSealer, list[list[str]]]:
+        """rows with every password still sealed and the sealer for them, converts an older vault on the way"""
+        vault = self.read_vault(password)
+        if isinstance(vault, dict):
+            return FieldSealer(password, bytes.fromhex(vault['field_salt']), self.derive, vault.get('field_kdf')), vault['rows']
+
+        fields = FieldSealer(password, derive=self.derive, kdf=self.kdf)
+        rows = [row[:2] + [fields.seal(row[2]) if row[2] else ''] for row in vault]
+        self.update(password, fields.dumps(rows))
+        return fields, rows
+
+class Journal:
+    """
+    Append-only sidecar (<vault>.journal) of encrypted row edits: JOURNAL_MAGIC, the vault's salt, then records
+    of a length followed by nonce + ciphertext + tag, authenticated with the header and their position.
+    Every record overwrites whole rows, so replaying it on a vault that already has it changes nothing.
+    The key comes from the vault's key (see FileInterface.vault_key), so only a checked password writes records.
+    A journal of another vault (different salt) or with records that don't authenticate is set aside
+    as <vault>.journal.bad instead of failing the login, the good records get carried over.
+    size(), clear() and set_aside() don't need a key.
+    """
+    def __init__(self, vault_path:Path|str, vault_key:bytes|None = None, salt:bytes|None = None):
+        self.path = Path(str(vault_path) + '.journal')
+        self.key = hmac.new(bytes(vault_key), b'vault journal', 'sha256').digest() if vault_key is not None else b''
+        self.header = JOURNAL_MAGIC + (salt or b'')
+
+    def size(self):
+        return self.path.stat().st_size if self.path.exists() else 0
+
+    def records(self, src:BinaryIO):
+        """yields the raw records, a torn record at the end (crash while appending) is dropped"""
+        while len(prefix := src.read(4)) == 4:
+            length, = struct.unpack('>I', prefix)
+            record = src.read(length)
+            if len(record) < length:
+                return
+            yield record
+
+    def read_header(self):
+        with open(self.path, 'rb') as file:
+            return file.read(len(self.header))
+
+    def set_aside(self):
+        os.replace(self.path, self.path.with_name(self.path.name + '.bad'))
+
+    def append(self, rows:dict[int, list[str]]):
+        if self.path.exists() and self.read_header() != self.header:
+            self.set_aside()
+        if not self.path.exists():
+            with open(self.path, 'wb') as file:
+                file.write(self.header)
+
+        with open(self.path, 'r+b') as file:
+            header = file.read(len(self.header))
+            index, end = 0, file.tell()
+            for _ in self.records(file):
+                index, end = index + 1, file.tell()
+            file.seek(end)
+            file.truncate() # drop a torn record before appending
+
+            payload = json.dumps(sorted(rows.items())).encode()
+            cipher = eax(self.key, secrets.token_bytes(NONCE_SIZE))
+            cipher.update(header + struct.pack('>Q', index))
+            ciphertext, tag = cipher.encrypt_and_digest(payload)
+            record = cipher.nonce + ciphertext + tag
+            file.write(struct.pack('>I', len(record)) + record)
+
+    def replay(self, rows:list[list[str]]):
+        if not self.path.exists():
+            return rows
+        if self.read_header() != self.header:
+            self.set_aside()
+            return rows
+
+        replayed:dict[int, list[str]] = {}
+        bad = 0
+        with open(self.path, 'rb') as file:
+            file.seek(len(self.header))
+            for index, record in enumerate(self.records(file)):
+                cipher = eax(self.key, record[:NONCE_SIZE])
+                cipher.update(self.header + struct.pack('>Q', index))
+                try:
+                    edits = json.loads(cipher.decrypt_and_verify(record[NONCE_SIZE:-TAG_SIZE], record[-TAG_SIZE:]))
+                except ValueError:
+                    bad += 1
+                    continue
+                for row, values in edits:
+                    while row >= len(rows):
+                        rows.append(['', '', ''])
+                    rows[row] = replayed[row] = values
+
+        if bad:
+            self.set_aside()
+            if replayed:
+                self.append(replayed)
+        return rows
+
+    def clear(self):
+        if self.path.exists():
+            os.remove(self.path)
+
+class BackgroundSaver:
+    """
+    Saves vault row edits on its own thread. Edits handed to save() within `delay` seconds
+    of each other are coalesced into one journal record, once the journal grows past
+    JOURNAL_LIMIT (and on close) it gets compacted with a full rewrite of the vault.
+    Keeps its own (columnar) copy of the rows, so compacting never reads the table from this thread.
+    state is one of 'pending', 'saving', 'saved' or 'failed' (see error).
+    """
+    def __init__(self, file_path:Path|str, password:str, rows:Iterable[list[str]], keys:KeyCache|None = None, delay:float = 0.3, fields:FieldSealer|None = None):
+        self.file_path = Path(file_path)
+        self.password = password
+        self.keys = keys
+        self.fields = fields # rows hold sealed passwords, keep the sealed layout
+        self.delay = delay
+        self.rows = ColumnStore(rows)
+        self.state = 'saved'
+        self.error:Exception|None = None
+        self.queue:queue.Queue[dict[int, list[str]]|None] = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, rows:dict[int, list[str]]):
+        """rows maps row index to the full new row, a new row has index len(rows)"""
+        self.state = 'pending'
+        self.queue.put({row: list(values) for row, values in rows.items()})
+
+    def write(self, edits:dict[int, list[str]]):
+        for row, values in sorted(edits.items()):
+            while row >= len(self.rows):
+                self.rows.append(['', '', ''])
+            for column, text in enumerate(values):
+                self.rows.set(row, column, text)
+
+        file = FileInterface(self.file_path, self.keys)
+        if file.append_rows(self.password, edits) > JOURNAL_LIMIT:
+            self.compact()
+
+    def compact(self):
+        rows = self.rows.rows()
+        content = self.fields.dumps(rows) if self.fields else json.dumps(rows).encode()
+        FileInterface(self.file_path, self.keys).update(self.password, content)
+
+    def run(self):
+        while True:
+            edits = self.queue.get()
+            if edits is None:
+                self.queue.task_done()
+                return
+
+            time.sleep(self.delay) # let a burst of edits pile up
+            taken = 1
+            stop = False
+            while True:
+                try:
+                    newer = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                taken += 1
+                if newer is None:
+                    stop = True
+                    break
+                edits.update(newer)
+
+            self.state = 'saving'
+            try:
+                self.write(edits)
+                self.error = None
+                self.state = 'saved' if self.queue.empty() else 'pending'
+            except Exception as e:
+                self.error = e
+                self.state = 'failed'
+
+            for _ in range(taken):
+                self.queue.task_done()
+            if stop:
+                return
+
+    def flush(self):
+        """blocks until everything handed to save() so far is written"""
+        self.queue.join()
+
+    def close(self):
+        """never raises, a failed last write ends up in state and error like one on the thread"""
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if Journal(self.file_path).size() and self.state != 'failed':
+            try:
+                self.compact()
+            except Exception as e:
+                self.error = e
+                self.state = 'failed'
+
+class Cancelled(Exception):
+    pass
+
+class Job:
+    """
+    Runs func(progress) on its own thread, so the caller's event loop keeps going. func hands progress
+    on to FileInterface / StreamCrypTor, once cancel() was called the next report raises Cancelled,
+    which aborts the pipeline (write_atomic drops the half written file). The kdf itself can't be
+    interrupted, a cancel during it lands right after.
+    state is one of 'running', 'done', 'failed' (see error) or 'cancelled', on_done runs on the job's thread.
+    """
+    def __init__(self, func:Callable, on_done:Callable[[], None]|None = None):
+        self.func = func
+        self.on_done = on_done
+        self.stage = 'starting'
+        self.done = 0
+        self.total:int|None = None
+        self.state = 'running'
+        self.result = None
+        self.error:Exception|None = None
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def progress(self, stage:str, done:int = 0, total:int|None = None):
+        if self.cancelled.is_set():
+            raise Cancelled()
+        self.stage, self.done, self.total = stage, done, total
+
+    def fraction(self):
+        """share of the current stage that is done, None when that isn't known"""
+        return min(1.0, self.done / self.total) if self.total else None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        try:
+            self.result = self.func(self.progress)
+            self.state = 'done'
+        except Cancelled:
+            self.state = 'cancelled'
+        except Exception as e:
+            self.error = e
+            self.state = 'failed'
+        finally:
+            if self.on_done:
+                self.on_done()
+
+    def wait(self):
+        self.thread.join()
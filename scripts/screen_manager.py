@@ -1,14 +1,15 @@
 import sys
 import os
 import pygame
-import json
 
 from pathlib import Path
-from tkinter.filedialog import askopenfilename
 
-from .ui_elements import TextField, Button, LogField, Table
+from .ui_elements import TextField, Button, LogField, Table, TEXT_CACHE
 from .const import Size, Colors, Misc
-from .file_handler import FileInterface
+from .file_handler import FileInterface, KeyCache, BackgroundSaver, Job, FormatError
+from .store import ColumnStore
+
+JOB_DONE = pygame.event.custom_type() # posted from a Job's thread, wakes the event loop
 
 class Login:
     def __init__(self) -> None:
@@ -22,6 +23,9 @@ class Login:
         self.button_login = Button((30,200,140,40),'Login')
         self.log_field = LogField((0,250,200,50))
         self.logo = Misc.logo
+        self.job:Job|None = None # file work runs off the event thread, see handle_file
+        self.action = ''
+        self.keys:KeyCache|None = None
 
         # automatically select password.vault file if avaibalble
         if os.path.exists('password.vault'):
@@ -35,6 +39,7 @@ class Login:
             self.log_field.title = 'no file selected'
 
         self.ui_elements = [self.password_box, self.button_login, self.log_field, self.button_select]
+        self.dirty_rects:list[pygame.Rect] = [] # changed since the last display update
         self.draw()
 
     def handle_event(self, event:pygame.Event):
@@ -42,29 +47,45 @@ class Login:
             pygame.quit()
             sys.exit(1)
 
-        for e in self.password_box.handle_event(event):
+        if event.type == JOB_DONE and self.job:
+            return self.finish_job()
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE and self.job:
+            self.job.cancel()
+
+        for e in self.password_box.handle_event(event) if not self.job else (): # the job already took the password
             if e == 'draw':
-                self.surface.blit(self.password_box.surface, self.password_box.rect.topleft)
+                self.blit(self.password_box)
             elif e == 'textfield_return' and self.selected_file:
                 return self.handle_file()
 
         for e in self.button_login.handle_event(event):
             if e == 'draw':
-                self.surface.blit(self.button_login.surface, self.button_login.rect.topleft)
+                self.blit(self.button_login)
+            elif e == 'pressed' and self.job:
+                self.job.cancel()
             elif e == 'pressed' and self.selected_file:
                 return self.handle_file()
 
-        for e in self.button_select.handle_event(event):
+        for e in self.button_select.handle_event(event) if not self.job else ():
             if e == 'draw':
-                self.surface.blit(self.button_select.surface, self.button_select.rect.topleft)
+                self.blit(self.button_select)
 
             elif e == 'pressed':
+                from tkinter.filedialog import askopenfilename # tkinter only loads once the dialog is wanted
                 file = askopenfilename()
                 if not isinstance(file, str): return
                 self.selected_file = file
                 self.log_field.body = file
+                info = FileInterface.detect(file) # header only, no kdf or decryption yet
+
+                if info and info.get('content') == 'vault':
+                    self.log_field.set('vault file', self.selected_file, Colors.log_green)
+                    self.button_login.text = 'login'
+                elif info and info.get('content') == 'blob':
+                    self.log_field.set('lock file', self.selected_file, Colors.log_blue)
+                    self.button_login.text = 'decrypt'
 
-                if self.selected_file.endswith('.vault'):
+                elif self.selected_file.endswith('.vault'):
                     self.log_field.set('vault file', self.selected_file, Colors.log_green)
                     self.button_login.text = 'login'
                 elif self.selected_file.endswith('.lock'):
@@ -84,7 +105,12 @@ class Login:
 
                 self.draw()
 
+    def blit(self, element):
+        self.surface.blit(element.surface, element.rect.topleft)
+        self.dirty_rects.append(element.rect.copy())
+
     def draw(self):
+        self.dirty_rects.append(self.surface.get_rect())
         self.surface.fill(Colors.background)
         self.surface.blit(self.logo,(75,25))
 
@@ -93,25 +119,70 @@ class Login:
             self.surface.blit(e.surface, e.rect.topleft)
 
     def handle_file(self):
-        try:
-            match self.button_login.text:
-                case 'login':
-                    return self.open_manager()
-                case 'encrypt':
-                    FileInterface(self.selected_file).lock(self.password_box.text)
-                case 'decrypt':
-                    FileInterface(self.selected_file).unlock(self.password_box.text)
-                case 'convert':
-                    FileInterface(self.selected_file).lock(self.password_box.text)
-                    os.rename(self.selected_file+'.lock', 'password.vault')
-
-        except ValueError:
+        """starts the kdf and en/decryption as a Job, the button cancels it until finish_job"""
+        password, file = self.password_box.text, self.selected_file
+        match self.button_login.text:
+            case 'login':
+                keys = self.keys = KeyCache(password)
+                func = lambda progress: (Path(file), password, FileInterface(file, keys, progress).get_sealed(password))
+            case 'encrypt':
+                func = lambda progress: FileInterface(file, progress=progress).lock(password)
+            case 'decrypt':
+                func = lambda progress: FileInterface(file, progress=progress).unlock(password)
+            case 'convert':
+                def func(progress):
+                    FileInterface(file, progress=progress).lock(password, content='vault')
+                    os.rename(file+'.lock', 'password.vault')
+            case _:
+                return
+
+        self.action = self.button_login.text
+        self.button_login.text = 'cancel'
+        self.password_box.border_color = Colors.border
+        self.log_field.set('starting', self.selected_file, Colors.log_blue)
+        self.job = Job(func, lambda: pygame.event.post(pygame.Event(JOB_DONE)))
+        self.draw()
+
+    def show_progress(self):
+        """log field title for the running job, returns whether it changed"""
+        fraction = self.job.fraction()
+        title = self.job.stage + (f' {fraction:.0%}' if fraction is not None else '')
+        if self.job.cancelled.is_set():
+            title = 'cancelling'
+        if title == self.log_field.title:
+            return False
+        self.log_field.title = title
+        self.log_field.draw()
+        return True
+
+    def finish_job(self):
+        job, self.job = self.job, None
+        self.button_login.text = self.action
+        if job.state == 'done' and self.action == 'login':
+            return self.open_manager(job.result)
+        if self.keys:
+            self.keys.clear()
+            self.keys = None
+
+        if job.state == 'done':
+            self.log_field.set(f'{self.action} done', self.selected_file, Colors.log_green)
+        elif job.state == 'cancelled':
+            self.log_field.set(f'{self.action} cancelled', self.selected_file, Colors.log_yellow)
+        elif isinstance(job.error, FormatError):
+            self.log_field.set('cannot open this file', str(job.error), Colors.log_red)
+        elif isinstance(job.error, ValueError): # the MAC check and the container parser both raise ValueError
+            self.log_field.set('wrong password or broken file', self.selected_file, Colors.log_red)
             self.password_box.border_color = Colors.log_red
             self.password_box.draw()
-            self.draw()
+        else:
+            self.log_field.set(f'{self.action} failed', f'{type(job.error).__name__}: {job.error}', Colors.log_red)
+        self.draw()
 
-    def open_manager(self):
-        password_list = FileInterface(self.selected_file).get_passwords(self.password_box.text)
+    def open_manager(self, result:tuple):
+        """result of the login job, the file and password it used and not what the widgets say now"""
+        keys, self.keys = self.keys, None
+        path, password, sealed = result
+        fields, password_list = sealed
 
         # Several checks to see if the input file is good
         if all([
@@ -119,21 +190,37 @@ class Login:
             isinstance(password_list[0], list),
             isinstance(password_list[0][0], str)
         ]):
-            return Manager(Path(self.selected_file),self.password_box.text)
+            return Manager(path, password, keys, sealed)
         else:
+            fields.clear()
+            keys.clear()
             self.log_field.title = 'Not a vault file'
             self.log_field.title_color = Colors.log_red
             self.log_field.body = "File successfully encrypted, but isn't the proper layout"
+            self.log_field.draw()
+            self.draw()
+
+    def is_animating(self):
+        """a running job needs frames for its progress"""
+        return self.job is not None
 
     def update(self):
-        ...
+        """returns the rects that changed since the last call, for pygame.display.update"""
+        if self.job and self.show_progress():
+            self.blit(self.log_field)
+        rects, self.dirty_rects = self.dirty_rects, []
+        return rects
 
 class Manager:
-    def __init__(self, vault_file_path:Path, password_cleartext:str) -> None:
+    def __init__(self, vault_file_path:Path, password_cleartext:str, keys:KeyCache|None = None, sealed:tuple|None = None) -> None:
         self.surface = pygame.display.set_mode(Size.winsize_manager, pygame.SRCALPHA, vsync=1)
         self.vault_file_path = vault_file_path
         self.password_cleartext = password_cleartext
-        self.password_list = FileInterface(self.vault_file_path).get_passwords(self.password_cleartext)
+        self.keys = keys or KeyCache(password_cleartext)
+        self.fields, rows = sealed or FileInterface(self.vault_file_path, self.keys).get_sealed(self.password_cleartext) # Login hands over what it read
+        self.password_list = ColumnStore(rows)
+        self.saver = BackgroundSaver(self.vault_file_path, self.password_cleartext, self.password_list, self.keys, fields=self.fields)
+        self.save_state = self.saver.state
         
         self.search_bar = TextField((
                 Size.padding,
@@ -147,13 +234,15 @@ class Manager:
                 Size.search_bar_height + Size.padding*2,
                 Size.winsize_manager[0],
                 Size.winsize_manager[1] - Size.search_bar_height - Size.padding*2
-            ), self.password_list)
+            ), self.password_list, self.fields)
 
         self.ui_elements = [self.table, self.search_bar]
+        self.dirty_rects:list[pygame.Rect] = [] # changed since the last display update
         self.draw()
 
     def handle_event(self, event:pygame.Event):
         if event.type == pygame.QUIT:
+            self.close()
             pygame.quit()
             sys.exit(1)
 
@@ -162,32 +251,72 @@ class Manager:
                 if self.table.tmp_txt:
                     self.table.tmp_txt = None
                     self.table.tmp_txt_index = None
+                    self.table.mark()
                 else:
+                    self.close()
                     return Login()
 
         for e in self.search_bar.handle_event(event):
             if e == 'draw':
-                self.surface.blit(self.search_bar.surface, self.search_bar.rect.topleft)
+                self.dirty_rects.append(self.search_bar.rect.copy())
             elif e == 'text_changed':
-                self.table.search_term = self.search_bar.text.lower()
-                self.table.scroll_to_search()
-                self.table.draw()
-                self.surface.blit(self.table.surface, self.table.rect.topleft)
+                self.table.set_search(self.search_bar.text.lower())
 
         for e in self.table.handle_event(event):
-            if e == 'draw':
-                self.surface.blit(self.table.surface, self.table.rect.topleft)
-            elif e == 'update_file':
-                content = json.dumps(self.table.content).encode()
-                FileInterface(self.vault_file_path).update(self.password_cleartext, content)
+            if e == 'update_file':
+                self.saver.save({row: self.table.content[row] for row in self.table.edited_rows})
+                self.table.edited_rows.clear()
 
     def draw(self):
+        self.dirty_rects.append(self.surface.get_rect())
         self.surface.fill(Colors.background)
 
         for element in self.ui_elements:
             self.surface.blit(element.surface, element.rect.topleft)
 
+    def compose(self):
+        """re-blits only the dirty parts of the window, returns them for pygame.display.update"""
+        rects, self.dirty_rects = self.dirty_rects, []
+        for rect in rects:
+            self.surface.fill(Colors.background, rect)
+            for element in self.ui_elements:
+                area = rect.clip(element.rect)
+                if area:
+                    self.surface.blit(element.surface, area.topleft, area.move(-element.rect.x, -element.rect.y))
+        return rects
+
+    def close(self):
+        """writes out pending edits, then forgets the session keys and the rendered vault text"""
+        self.saver.close()
+        self.fields.clear()
+        self.keys.clear()
+        TEXT_CACHE.clear()
+
+    def show_save_state(self):
+        if self.saver.state == self.save_state:
+            return False
+        self.save_state = self.saver.state
+        self.search_bar.border_color = {
+            'pending': Colors.log_yellow,
+            'saving': Colors.log_blue,
+            'failed': Colors.log_red,
+        }.get(self.save_state, Colors.border)
+        self.search_bar.draw()
+        return True
+
+    def is_animating(self):
+        """scrolling or a save in flight, both need frames without any user input"""
+        return self.table.velocity != 0 or self.saver.state in ('pending', 'saving')
+
     def update(self):
-        self.table.update()
-        self.draw()
+        """returns the rects that changed since the last call, for pygame.display.update"""
+        if self.show_save_state():
+            self.dirty_rects.append(self.search_bar.rect.copy())
+
+        if self.table.velocity or self.table.dirty_rects:
+            self.table.update()
+            self.dirty_rects += [rect.move(self.table.rect.topleft).clip(self.table.rect) for rect in self.table.dirty_rects]
+            self.table.dirty_rects.clear()
+
+        return self.compose()
 
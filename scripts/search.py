@@ -0,0 +1,129 @@
+import heapq
+import re
+from bisect import bisect_left, insort
+from typing import Iterable
+
+class SearchIndex:
+    """
+    Substring and fuzzy search over the name and username columns of a vault.
+    Keeps a lowercase copy of both columns (one string per row), a trigram -> rows index
+    and both columns sorted for prefix lookups. Results of the prefixes of the current term are kept, so typing only
+    refines the previous result and backspace goes back to one that is already known.
+    """
+    columns = 0, 1
+
+    def __init__(self, rows:Iterable[list[str]]):
+        self.joined:list[str] = [] # lower columns joined by \0, one `in` per row for the short terms
+        self.trigrams:dict[str, set[int]] = {}
+        self.results:dict[str, set[int]] = {}
+        self.fuzzy:dict[str, set[int]] = {}
+        for row, values in enumerate(rows):
+            self.add(row, values)
+        self.sorted:list[list[tuple[str, int]]] = [
+            sorted((self.lower(row)[column], row) for row in range(len(self.joined)))
+            for column in range(len(self.columns))
+        ]
+
+    @staticmethod
+    def grams(text:str):
+        return {text[i:i+3] for i in range(len(text) - 2)}
+
+    def lower(self, row:int) -> list[str]:
+        return self.joined[row].split('\0')
+
+    def add(self, row:int, values:list[str]):
+        while len(self.joined) <= row:
+            self.joined.append('\0' * (len(self.columns) - 1))
+        self.joined[row] = '\0'.join((values[column] or '').lower() for column in self.columns)
+        for text in self.lower(row):
+            for gram in self.grams(text):
+                self.trigrams.setdefault(gram, set()).add(row)
+        self.results.clear()
+        self.fuzzy.clear()
+
+    def update(self, row:int, values:list[str]):
+        """re-index a row after an edit, also used for appended rows"""
+        if row < len(self.joined):
+            for column, text in enumerate(self.lower(row)):
+                entries = self.sorted[column]
+                del entries[bisect_left(entries, (text, row))]
+                for gram in self.grams(text):
+                    rows = self.trigrams.get(gram)
+                    if rows:
+                        rows.discard(row)
+                        if not rows:
+                            del self.trigrams[gram]
+        else:
+            for column in range(len(self.columns)):
+                for new_row in range(len(self.joined), row):
+                    insort(self.sorted[column], ('', new_row))
+
+        self.add(row, values)
+        for column, text in enumerate(self.lower(row)):
+            insort(self.sorted[column], (text, row))
+
+    def matches(self, row:int, term:str):
+        return term in self.joined[row]
+
+    def candidates(self, term:str):
+        """rows that may contain term, narrowed as far as the known results allow"""
+        known = max((prefix for prefix in self.results if term.startswith(prefix)), key=len, default=None)
+        grams = self.grams(term)
+        if known is not None and (len(known) >= 3 or not grams): # trigrams narrow down better than 1 or 2 letters
+            return self.results[known]
+        if not grams:
+            return range(len(self.joined))
+        sets = sorted((self.trigrams.get(gram, set()) for gram in grams), key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def hits(self, term:str) -> set[int]:
+        """rows whose name or username contains the lowercase term"""
+        if term not in self.results:
+            self.results = {prefix: rows for prefix, rows in self.results.items() if term.startswith(prefix)}
+            self.results[term] = {row for row in self.candidates(term) if self.matches(row, term)}
+        return self.results[term]
+
+    def prefix_hits(self, column:int, term:str) -> set[int]:
+        """rows whose column starts with the lowercase term, a bisect on the sorted column"""
+        entries = self.sorted[column]
+        start = bisect_left(entries, (term, -1))
+        end = bisect_left(entries, (term[:-1] + chr(ord(term[-1]) + 1), -1))
+        return {row for _, row in entries[start:end]}
+
+    def fuzzy_hits(self, term:str) -> set[int]:
+        """rows where term is a subsequence of the name or username, refined per keystroke like hits"""
+        if len(term) == 1:
+            return self.hits(term)
+        if term not in self.fuzzy:
+            self.fuzzy = {prefix: rows for prefix, rows in self.fuzzy.items() if term.startswith(prefix)}
+            known = max(self.fuzzy, key=len, default=None)
+            candidates = self.fuzzy[known] if known is not None else self.hits(term[0])
+            # 'abc' -> a[^\0]*b[^\0]*c, so a match never spans from the name into the username
+            pattern = re.compile('[^\0]*'.join(map(re.escape, term)))
+            self.fuzzy[term] = {row for row in candidates if pattern.search(self.joined[row])}
+        return self.fuzzy[term]
+
+    def rank(self, term:str, limit:int):
+        """
+        Best `limit` rows for term: name prefix, then username prefix, then substring
+        and last subsequence matches, vault order within each group.
+        """
+        if not term:
+            return list(range(min(limit, len(self.joined))))
+
+        name_prefix = self.prefix_hits(0, term)
+        username_prefix = self.prefix_hits(1, term) - name_prefix
+        substring = self.hits(term) - name_prefix - username_prefix
+        groups = (
+            lambda: name_prefix,
+            lambda: username_prefix,
+            lambda: substring,
+            lambda: self.fuzzy_hits(term) - self.hits(term), # only computed when the rest doesn't fill the view
+        )
+
+        ranked:list[int] = []
+        for group in groups:
+            ranked += heapq.nsmallest(limit - len(ranked), group())
+            if len(ranked) >= limit:
+                break
+        return ranked
@@ -0,0 +1,74 @@
+from array import array
+from typing import Iterable
+
+class ColumnStore:
+    """
+    Vault rows kept column by column: each column is one utf-8 buffer plus the start and
+    length of every cell in it, instead of a list and three str objects per row.
+    Cells are decoded when they are read. An edit that doesn't fit in place is appended
+    to the end of the buffer, the old bytes get reclaimed once they are half the buffer.
+    """
+    def __init__(self, rows:Iterable[list[str|None]] = (), columns:int = 3):
+        self.columns = columns
+        self.buffers = [bytearray() for _ in range(columns)]
+        self.starts = [array('I') for _ in range(columns)]
+        self.lengths = [array('I') for _ in range(columns)]
+        self.waste = [0] * columns # bytes no cell points to anymore
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return len(self.starts[0])
+
+    def __getitem__(self, row:int) -> list[str]:
+        """a copy of the row, change cells with set()"""
+        return [self.get(row, column) for column in range(self.columns)]
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def get(self, row:int, column:int) -> str:
+        start = self.starts[column][row]
+        return self.buffers[column][start:start + self.lengths[column][row]].decode()
+
+    def set(self, row:int, column:int, text:str|None):
+        data = (text or '').encode()
+        buffer, starts, lengths = self.buffers[column], self.starts[column], self.lengths[column]
+        start, length = starts[row], lengths[row]
+        if len(data) <= length:
+            buffer[start:start + len(data)] = data
+            self.waste[column] += length - len(data)
+        else:
+            starts[row] = len(buffer)
+            buffer += data
+            self.waste[column] += length
+        lengths[row] = len(data)
+        if self.waste[column] > len(buffer) // 2:
+            self.compact(column)
+
+    def append(self, values:list[str|None]):
+        for column in range(self.columns):
+            data = (values[column] or '').encode()
+            self.starts[column].append(len(self.buffers[column]))
+            self.lengths[column].append(len(data))
+            self.buffers[column] += data
+
+    def compact(self, column:int):
+        """rewrites a column buffer without the bytes left behind by edits"""
+        buffer, starts, lengths = self.buffers[column], self.starts[column], self.lengths[column]
+        packed = bytearray()
+        for row in range(len(starts)):
+            start = starts[row]
+            starts[row] = len(packed)
+            packed += buffer[start:start + lengths[row]]
+        self.buffers[column] = packed
+        self.waste[column] = 0
+
+    def rows(self) -> list[list[str]]:
+        """plain lists, for json"""
+        return list(self)
+
+    def nbytes(self):
+        return sum(len(buffer) + starts.itemsize * len(starts) + lengths.itemsize * len(lengths)
+            for buffer, starts, lengths in zip(self.buffers, self.starts, self.lengths))
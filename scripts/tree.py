@@ -0,0 +1,158 @@
+import io
+import os
+import json
+import hashlib
+from pathlib import Path
+from functools import partial
+from typing import Callable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .file_handler import FileInterface, StreamCrypTor, CrypTor, WORKERS, CHUNK_SIZE, KDF
+
+MANIFEST = '.tree-manifest.lock'
+
+def fixed_key(key:bytes, salt:bytes, kdf:dict, password:str, requested_salt:bytes|None = None, requested_kdf:dict|None = None):
+    """derive for files of one tree run, the password was already stretched once by the parent"""
+    if requested_salt not in (None, salt) or requested_kdf not in (None, kdf):
+        return CrypTor(b'').pass_to_key(password, requested_salt, requested_kdf)
+    return key, salt
+
+class HashingReader:
+    """file wrapper that hashes everything read through it, so locking and hashing is one pass"""
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.blake2b()
+
+    def read(self, size:int = -1):
+        data = self.file.read(size)
+        self.hash.update(data)
+        return data
+
+def file_hash(path:Path):
+    with open(path, 'rb') as file:
+        reader = HashingReader(file)
+        while reader.read(CHUNK_SIZE):
+            pass
+    return reader.hash.hexdigest()
+
+def lock_file(src:Path, dst:Path, key:bytes, salt:bytes, kdf:dict, known_hash:str|None, compression:str|None = None):
+    """runs in a worker process, returns (hash, locked), a file whose content still hashes to known_hash is left alone"""
+    if known_hash is not None and dst.exists():
+        content_hash = file_hash(src)
+        if content_hash == known_hash:
+            return content_hash, False
+
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    crypter = StreamCrypTor(workers=1, derive=partial(fixed_key, key, salt, kdf), compression=compression, kdf=kdf) # the pool already keeps every core busy
+    with open(src, 'rb') as file:
+        reader = HashingReader(file)
+        FileInterface.write_atomic(dst, lambda out: crypter.lock(reader, out, '')) # type: ignore
+    return reader.hash.hexdigest(), True
+
+class TreeLocker:
+    """
+    Encrypts every file of a directory tree to <name>.lock, next to the original or mirrored under out_dir,
+    on a process pool. An encrypted manifest in the output root keeps path, size, mtime and a blake2b hash
+    of every file, so later runs only lock files that changed. A file whose size or mtime changed but whose
+    hash didn't only gets its manifest entry refreshed, one that's gone gets its .lock deleted. The password gets stretched once per run,
+    all files of a run share the manifest's salt and kdf (every chunk still gets its own nonce).
+    kdf only applies to a new tree, an existing one keeps the kdf its manifest was locked with.
+    """
+    def __init__(self, root:Path|str, out_dir:Path|str|None = None, workers:int = WORKERS, compression:str|None = None, kdf:dict|None = None):
+        self.root = Path(root)
+        self.compression = compression
+        self.kdf = kdf or KDF
+        self.out_dir = Path(out_dir) if out_dir else self.root
+        self.manifest_path = self.out_dir / MANIFEST
+        self.workers = max(1, workers)
+
+    def target(self, relative:str):
+        return self.out_dir / (relative + '.lock')
+
+    def remove_output(self, relative:str):
+        """deletes the .lock of a file that's gone, and mirror directories that end up empty"""
+        target = self.target(relative)
+        target.unlink(missing_ok=True)
+        if self.out_dir.resolve() == self.root.resolve():
+            return
+        for directory in target.parents:
+            if directory == self.out_dir or any(directory.iterdir()):
+                break
+            directory.rmdir()
+
+    def walk(self):
+        """relative path -> stat of every file that isn't an output of a tree run"""
+        files = {}
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = Path(directory, name)
+                if name.endswith(('.lock', '.tmp')) or name == MANIFEST:
+                    continue
+                files[path.relative_to(self.root).as_posix()] = path.stat()
+        return files
+
+    def read_manifest(self, password:str):
+        """(key, salt, entries), a new salt and key for the first run"""
+        if not self.manifest_path.exists():
+            key, salt = CrypTor(b'').pass_to_key(password, None, self.kdf)
+            return key, salt, {}
+
+        with open(self.manifest_path, 'rb') as file:
+            info, _ = StreamCrypTor.read_header(file)
+        salt = bytes.fromhex(info['salt'])
+        self.kdf = info.get('kdf', KDF)
+        key, _ = CrypTor(b'').pass_to_key(password, salt, self.kdf)
+        data = io.BytesIO()
+        with open(self.manifest_path, 'rb') as file:
+            StreamCrypTor(derive=partial(fixed_key, key, salt, self.kdf)).unlock(file, data, password)
+        return key, salt, json.loads(data.getvalue())
+
+    def write_manifest(self, key:bytes, salt:bytes, entries:dict):
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        content = io.BytesIO(json.dumps(entries).encode())
+        crypter = StreamCrypTor(derive=partial(fixed_key, key, salt, self.kdf), kdf=self.kdf)
+        FileInterface.write_atomic(self.manifest_path, lambda out: crypter.lock(content, out, ''))
+
+    def lock(self, password:str, progress:Callable[[str, str, str], None]|None = None):
+        """
+        returns {'locked', 'unchanged', 'touched', 'removed', 'failed'} -> relative paths,
+        progress(status, path, error) is called for every file that needed work or got removed
+        """
+        key, salt, entries = self.read_manifest(password)
+        files = self.walk()
+        result:dict[str, list[str]] = {status: [] for status in ('locked', 'unchanged', 'touched', 'removed', 'failed')}
+
+        for relative in set(entries) - set(files):
+            del entries[relative]
+            self.remove_output(relative)
+            result['removed'].append(relative)
+            if progress:
+                progress('removed', relative, '')
+
+        jobs = {}
+        with ProcessPoolExecutor(self.workers) as pool:
+            for relative, stat in files.items():
+                size, mtime, content_hash = entries.get(relative, (None, None, None))
+                if (size, mtime) == (stat.st_size, stat.st_mtime_ns) and self.target(relative).exists():
+                    result['unchanged'].append(relative)
+                    continue
+                job = pool.submit(lock_file, self.root / relative, self.target(relative), key, salt, self.kdf, content_hash, self.compression)
+                jobs[job] = relative, stat
+
+            for job in as_completed(jobs):
+                relative, stat = jobs[job]
+                error = ''
+                try:
+                    content_hash, locked = job.result()
+                except Exception as e:
+                    entries.pop(relative, None) # retried on the next run
+                    status, error = 'failed', f'{type(e).__name__}: {e}'
+                else:
+                    entries[relative] = stat.st_size, stat.st_mtime_ns, content_hash
+                    status = 'locked' if locked else 'touched'
+                result[status].append(relative)
+                if progress:
+                    progress(status, relative, error)
+
+        self.write_manifest(key, salt, entries)
+        return result
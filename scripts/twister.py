@@ -1,3 +1,6 @@
+import random
+import numpy as np
+
 class MersenneTwister:
     """Written by chatgpt"""
     def __init__(self, seed):
@@ -8,16 +11,17 @@ class MersenneTwister:
         self.t, self.c = 15, 0xEFC60000
         self.l = 18
         self.f = 1812433253
-        self.mt = [0] * self.n
+        self.mt = np.zeros(self.n, np.uint32)
         self.index = self.n + 1
         self.lower_mask = (1 << self.r) - 1
         self.upper_mask = (~self.lower_mask) & 0xFFFFFFFF
         self.seed_mt(seed)
 
     def seed_mt(self, seed:int):
-        self.mt[0] = seed & 0xFFFFFFFF
+        mt = [seed & 0xFFFFFFFF]
         for i in range(1, self.n):
-            self.mt[i] = (self.f * (self.mt[i - 1] ^ (self.mt[i - 1] >> (self.w - 2))) + i) & 0xFFFFFFFF
+            mt.append((self.f * (mt[i - 1] ^ (mt[i - 1] >> (self.w - 2))) + i) & 0xFFFFFFFF)
+        self.mt = np.array(mt, np.uint32)
         self.index = self.n
 
     def extract_number(self):
@@ -26,7 +30,7 @@ class MersenneTwister:
                 raise Exception("Generator was never seeded")
             self.twist()
 
-        y = self.mt[self.index]
+        y = int(self.mt[self.index])
         y ^= (y >> self.u) & self.d
         y ^= (y << self.s) & self.b
         y ^= (y << self.t) & self.c
@@ -36,15 +40,97 @@ class MersenneTwister:
         return y & 0xFFFFFFFF
 
     def twist(self):
-        for i in range(self.n):
-            x = (self.mt[i] & self.upper_mask) + (self.mt[(i + 1) % self.n] & self.lower_mask)
-            xA = x >> 1
-            if x % 2 != 0:
-                xA ^= self.a
-            self.mt[i] = self.mt[(i + self.m) % self.n] ^ xA
+        # mt[i] depends on mt[i+1] (still old) and mt[i+m-n] (already new once i >= n-m),
+        # so the state can be updated in blocks of n-m without changing the result
+        mt = self.mt
+        step = self.n - self.m
+        for start in range(0, self.n - 1, step):
+            stop = min(start + step, self.n - 1)
+            x = (mt[start:stop] & self.upper_mask) | (mt[start+1:stop+1] & self.lower_mask)
+            xA = (x >> 1) ^ ((x & 1) * np.uint32(self.a))
+            src = (start + self.m) % self.n
+            mt[start:stop] = mt[src:src+stop-start] ^ xA
+        x = (mt[-1] & self.upper_mask) | (mt[0] & self.lower_mask)
+        mt[-1] = mt[self.m - 1] ^ (x >> 1) ^ ((x & 1) * np.uint32(self.a))
         self.index = 0
 
+    def temper(self, y:np.ndarray):
+        y = y ^ (y >> self.u)
+        y ^= (y << self.s) & np.uint32(self.b)
+        y ^= (y << self.t) & np.uint32(self.c)
+        y ^= y >> self.l
+        return y
+
+    def extract_batch(self, count:int, batch_size:int = 1 << 20):
+        """same numbers as calling extract_number count times, as one uint32 array"""
+        if self.index > self.n:
+            raise Exception("Generator was never seeded")
+        out = np.empty(count, np.uint32)
+        head = min(self.n - self.index, count)
+        out[:head] = self.temper(self.mt[self.index:self.index+head])
+        self.index += head
+        if head == count:
+            return out
+
+        # the random module runs the same MT19937 in C, getrandbits hands out whole words in order
+        rng = random.Random()
+        rng.setstate((3, tuple(int(x) for x in self.mt) + (self.n,), None))
+        for start in range(head, count, batch_size):
+            size = min(batch_size, count - start)
+            out[start:start+size] = np.frombuffer(rng.getrandbits(32*size).to_bytes(4*size, 'little'), '<u4')
+        state = rng.getstate()[1]
+        self.mt = np.array(state[:-1], np.uint32)
+        self.index = state[-1]
+        return out
+
     def shuffle(self, lst):
         for i in range(len(lst) - 1, 0, -1):
             j = self.extract_number() % (i + 1)
             lst[i], lst[j] = lst[j], lst[i]
+
+    def permutation(self, length:int):
+        """
+        Returns what shuffle(list(range(length))) would leave in the list, without swapping.
+        Fisher-Yates step i swaps positions i and j_i with j_i <= i, so position i is final
+        after its own step and receives whatever sat at j_i at that moment. That value only
+        depends on the previous steps that also targeted j_i, which turns the whole shuffle
+        into chains of steps that can be resolved with pointer jumping.
+        """
+        if length < 2:
+            return np.arange(length, dtype=np.uint32)
+
+        # positions fit in 32 bits, so (target, step) packs into one sortable 64 bit key
+        targets = np.zeros(length, np.int64) # step 0 is a no-op swap of 0 with 0
+        targets[:0:-1] = self.extract_batch(length - 1) % np.arange(length, 1, -1, dtype=np.uint32)
+
+        # group steps by their target, in order of execution within each group
+        order = np.sort((targets << 32) | np.arange(length, dtype=np.int64))
+        grouped = (order >> 32).astype(np.uint32)
+        order = (order & 0xFFFFFFFF).astype(np.int32)
+        targets = targets.astype(np.uint32)
+
+        later = np.full(length, -1, np.int32) # next step that swaps with the same position
+        same = grouped[1:] == grouped[:-1]
+        later[order[:-1][same]] = order[1:][same]
+        first = np.full(length, -1, np.int32) # first step that swaps with a position
+        first[grouped[0]] = order[0]
+        np.logical_not(same, out=same)
+        first[grouped[1:][same]] = order[1:][same]
+        del grouped, order, same
+
+        # value sitting at position p right before step p: follow the steps that swapped with p
+        positions = np.arange(length, dtype=np.int32)
+        chain = np.where(first == positions, later, first)
+        del first
+        np.copyto(chain, positions, where=chain < 0)
+        del positions
+        active = np.flatnonzero(chain[chain] != chain).astype(np.int32)
+        while active.size:
+            jumped = chain[chain[active]]
+            moved = jumped != chain[active]
+            chain[active] = jumped
+            active = active[moved]
+
+        result = chain[np.maximum(later, 0)].astype(np.uint32)
+        np.copyto(result, targets, where=later < 0)
+        return result
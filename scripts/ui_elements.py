@@ -2,11 +2,107 @@
 import pygame
 from pygame.locals import * # type: ignore
 import string
+from collections import OrderedDict
 
 from .const import Colors, Font, Size
+from .search import SearchIndex
+from .store import ColumnStore
+from .file_handler import FieldSealer
+
+class TextCache:
+    """
+    LRU of rendered text surfaces shared by all ui elements, keyed on (font, text, color, background)
+    and limited by the pixel memory of the surfaces. Surfaces handed out are shared, only blit them.
+    The keys hold the text, plaintext passwords never go through here (see TextField.cache_text).
+    """
+    def __init__(self, max_bytes:int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries:OrderedDict[tuple, pygame.Surface] = OrderedDict()
+
+    def render(self, font:pygame.Font, text:str, color, background = None) -> pygame.Surface:
+        key = font, text, tuple(color), None if background is None else tuple(background)
+        surface = self.entries.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return surface
+
+        self.misses += 1
+        surface = font.render(text, True, color, background)
+        size = surface.get_width() * surface.get_height() * surface.get_bytesize()
+        if size <= self.max_bytes:
+            self.entries[key] = surface
+            self.used_bytes += size
+            while self.used_bytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.used_bytes -= old.get_width() * old.get_height() * old.get_bytesize()
+        return surface
+
+    def clear(self):
+        """forgets every surface, e.g. on logout when some of them show vault entries"""
+        self.entries.clear()
+        self.used_bytes = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate(), 'entries': len(self.entries), 'bytes': self.used_bytes}
+
+TEXT_CACHE = TextCache()
+
+def render_text(font:pygame.Font, text:str, color, background = None):
+    return TEXT_CACHE.render(font, text, color, background)
+
+class GlyphSet(dict):
+    """char -> glyph surface of one font and colors, a glyph gets rasterized the first time it's asked for"""
+    def __init__(self, font:pygame.Font, color, background = None):
+        self.font = font
+        self.color = color
+        self.background = background
+        self.advance = font.size('a')[0]
+
+    def __missing__(self, char:str):
+        glyph = self.font.render(char, True, self.color, self.background)
+        if pygame.display.get_surface():
+            glyph = glyph.convert() if self.background else glyph.convert_alpha()
+        self[char] = glyph
+        return glyph
+
+class GlyphAtlas:
+    """
+    Every glyph of the (monospace) font rasterized once per font and colors, strings are laid out on the
+    font's fixed advance and composed with one Surface.fblits call instead of a font.render per string.
+    Unlike TextCache nothing depends on the text itself, so scrolling through a large table costs the
+    same as standing still. Glyphs with a background are opaque and blit about twice as fast,
+    without one they can go on top of anything (e.g. search highlites).
+    """
+    def __init__(self):
+        self.sets:dict[tuple, GlyphSet] = {}
+
+    def glyphs(self, font:pygame.Font, color, background = None) -> GlyphSet:
+        key = font, tuple(color), None if background is None else tuple(background)
+        if key not in self.sets:
+            self.sets[key] = GlyphSet(font, color, background)
+        return self.sets[key]
+
+    def layout(self, font:pygame.Font, text:str, color, pos:tuple[float,float], width:float|None = None, background = None) -> list[tuple]:
+        """fblits() sequence for text at pos, only glyphs that fit into width pixels"""
+        glyphs = self.glyphs(font, color, background)
+        advance = glyphs.advance
+        x, y = pos
+        if width is not None:
+            text = text[:int(width // advance)]
+        return [(glyphs[char], (x + index * advance, y)) for index, char in enumerate(text) if char != ' ']
+
+GLYPHS = GlyphAtlas()
 
 class TextField:
-    def __init__(self, rect:pygame.Rect|tuple, default_text:str = '', active=False, is_password:bool = False, no_border = False):
+    def __init__(self, rect:pygame.Rect|tuple, default_text:str = '', active=False, is_password:bool = False, no_border = False, cache_text = True):
         self.rect = pygame.Rect(rect)
         self.surface = pygame.Surface(self.rect.size, SRCALPHA)
         self.font = Font.medium
@@ -23,8 +119,15 @@ class TextField:
         self.border_size = 1
         self.cursorspos = 0
         self.text_scroll = 0
+        self.cache_text = cache_text # False for plaintext that must not outlive the field in TEXT_CACHE
         self.draw()
 
+    def blit_text(self, text:str, color, background, pos):
+        if self.cache_text:
+            self.surface.blit(render_text(self.font, text, color, background), pos)
+        else:
+            self.surface.fblits(GLYPHS.layout(self.font, text or '', color, pos, background=background))
+
     def draw(self):
         color_background = Colors.hover if self.hover else Colors.input
         color_text = Colors.text_light if self.active else Colors.text_dark
@@ -35,24 +138,18 @@ class TextField:
         if self.draw_border:
             pygame.draw.rect(self.surface, self.border_color, ((0,0),self.rect.size), self.border_size, 10)
         
+        text_height = self.font.get_height()
         if not self.text:
-            text = self.font.render(self.text_default, True, Colors.text_dark, color_background)
-            textpos = (Size.padding, (self.rect.height - text.height)/2)
-            self.surface.blit(text, textpos)
-
-        if self.is_password:
-            text = self.font.render('*'*len(self.text), True, color_text, color_background)
-        else:
-            text = self.font.render(self.text, True, color_text, color_background)
+            self.blit_text(self.text_default, Colors.text_dark, color_background, (Size.padding, (self.rect.height - text_height)/2))
 
         dist = (self.rect.width - Size.padding*2) - self.font.size('a')[0]*len(self.text)
         self.text_scroll = min(0,dist)
         cursor_x = self.font.size('a')[0] * self.cursorspos + self.text_scroll + Size.padding
-        text_pos = (Size.padding + self.text_scroll, (self.rect.height - text.height)/2)
-        self.surface.blit(text, text_pos)
+        text_pos = (Size.padding + self.text_scroll, (self.rect.height - text_height)/2)
+        self.blit_text('*'*len(self.text) if self.is_password else self.text, color_text, color_background, text_pos)
 
         if self.active:
-            pygame.draw.rect(self.surface, color_text, (cursor_x,text_pos[1]+2,1,text.height-4)) # cursror line
+            pygame.draw.rect(self.surface, color_text, (cursor_x,text_pos[1]+2,1,text_height-4)) # cursror line
 
         if self.selection:
             if self.is_password:
@@ -60,13 +157,12 @@ class TextField:
             else:
                 txt = self.text[self.selection[0]:self.selection[1]]
 
-            selected_text = self.font.render(txt, True, color_text, Colors.select)
             selected_pos = self.selection[0] * self.font.size('a')[0] + text_pos[0], text_pos[1]
             padding = pygame.Vector2(2, 2)
-            selection_rect = selected_text.get_rect().move(-padding).move(selected_pos)
+            selection_rect = pygame.Rect(selected_pos, self.font.size(txt)).move(-padding)
             selection_rect.size = pygame.Vector2(selection_rect.size) + padding*2
             pygame.draw.rect(self.surface, Colors.select, selection_rect, 0, 5) # selection
-            self.surface.blit(selected_text, selected_pos)
+            self.blit_text(txt, color_text, Colors.select, selected_pos)
 
     def handle_event(self, event:pygame.Event):
         special_events:list[str] = []
@@ -266,7 +362,7 @@ class Button:
         pygame.draw.rect(self.surface, Colors.border, ((0,0),self.rect.size), 1, 10)
 
         if self.text:
-            text = self.font.render(self.text, True, Colors.text_light, color_background)
+            text = render_text(self.font, self.text, Colors.text_light, color_background)
             text_pos = (pygame.Vector2(self.rect.size)-text.size) / 2
             self.surface.blit(text,text_pos)
 
@@ -329,17 +425,16 @@ class LogField:
             return
         
         elif self.surface.height < font_height * 2: # title only
-            title = Font.small.render(self.title, True, self.title_color, Colors.background)
+            title = render_text(Font.small, self.title, self.title_color, Colors.background)
             self.surface.blit(title, (padding,self.surface.height - title.height))
 
         elif self.surface.height > font_height * (amt_y+1) and self.body: # full thing
-            title = Font.small.render(self.title, True, self.title_color,Colors.background)
+            title = render_text(Font.small, self.title, self.title_color,Colors.background)
             if self.body:
                 text_parts = [self.body[x:x+amt_x] for x in range(0, len(self.body), amt_x)]
-                surfaces = [Font.small.render(part,True,self.body_color,Colors.background) for part in text_parts]
                 positions = [(padding,self.surface.height-y*font_height) for y in range(1,amt_y+1)][::-1]
                 title_pos = padding, positions[0][1] - title.height
-                self.surface.blits(zip(surfaces,positions))
+                self.surface.fblits([glyph for part, pos in zip(text_parts, positions) for glyph in GLYPHS.layout(Font.small, part, self.body_color, pos, background=Colors.background)])
             else:
                 title_pos = padding, self.surface.height - title.height
             self.surface.blit(title, title_pos)
@@ -347,12 +442,11 @@ class LogField:
         elif self.surface.height < font_height * (amt_y+1) and self.body: # botton cutt off
             amt_y = int(self.surface.height/font_height)
             title_pos = (padding,0)
-            title = Font.small.render(self.title, True, self.title_color, Colors.background)
+            title = render_text(Font.small, self.title, self.title_color, Colors.background)
             text_parts = [self.body[x:x+amt_x] for x in range(0, len(self.body), amt_x)]
             positions = [(padding,title.height+y*font_height) for y in range(amt_y)]
-            surfaces = [Font.small.render(part,True,self.body_color,Colors.background) for part in text_parts]
             self.surface.blit(title, title_pos)
-            self.surface.blits(zip(surfaces,positions))
+            self.surface.fblits([glyph for part, pos in zip(text_parts, positions) for glyph in GLYPHS.layout(Font.small, part, self.body_color, pos, background=Colors.background)])
             fade_surf = pygame.Surface((self.surface.width, fade_size), pygame.SRCALPHA)
             # alpha_array = np.linspace(0, 255, fade_size, dtype=np.uint8)
             alpha_array = [int(x/fade_size*255) for x in range(fade_size)]
@@ -360,7 +454,7 @@ class LogField:
             self.surface.blit(fade_surf, (0,self.surface.height-fade_size))     
 
         else:
-            title = Font.small.render(self.title, True, self.title_color, Colors.background)
+            title = render_text(Font.small, self.title, self.title_color, Colors.background)
             self.surface.blit(title, (padding,self.surface.height - title.height))
 
     def resize(self, rect:pygame.Rect|tuple):
@@ -372,17 +466,23 @@ class LogField:
         return []
 
 class Table:
-    def __init__(self, rect:pygame.Rect|tuple, content:list[list[str]]) -> None:
+    def __init__(self, rect:pygame.Rect|tuple, content:ColumnStore, fields:FieldSealer|None = None) -> None:
         self.rect = pygame.Rect(rect)
         self.content = content
+        self.fields = fields # passwords in content are sealed, see reveal()
         #print(self.content)
         self.surface = pygame.Surface(self.rect.size, pygame.SRCALPHA)
         self.hover:tuple[int,int]|bool = False
         self.tmp_txt = None
         self.tmp_txt_index = None
         self.search_term = ''
+        self.view:list[int]|None = None # rows of content shown while searching, best match first
+        self.view_limit = 1000
         self.scroll_pos = 0
         self.velocity = 0
+        self.edited_rows:set[int] = set() # rows changed since the owner last saved
+        self.index = SearchIndex(content)
+        self.dirty_rects:list[pygame.Rect] = [] # parts of the surface that need a redraw, table coordinates
         self.draw()
 
     def draw(self):
@@ -391,30 +491,39 @@ class Table:
         cell_size_x = self.rect.width / 3
         cell_size_y = font_size[1]
 
-        for idx_y, line in enumerate(self.content):
+        # only rows between scroll_pos and scroll_pos + height end up on the surface
+        first_row = max(0, int(self.scroll_pos // cell_size_y))
+        last_row = min(self.row_count(), int((self.scroll_pos + self.rect.height) // cell_size_y) + 1)
+        glyphs = [] # every cell of the frame goes out in one blits call, after the highlites
+
+        for idx_y in range(first_row, last_row):
+            row = self.row_at(idx_y)
+            line = self.content[row]
+            lower = self.index.lower(row)
             for idx_x, entry in enumerate(line):
                 if entry is None:
                     entry = ''
                 if idx_x == 2:
-                    entry = '*' * len(entry)
-                _entry = entry.lower()
+                    entry = self.mask(entry)
                 
                 pos = idx_x * cell_size_x, idx_y * cell_size_y - self.scroll_pos
+                background = Colors.background # opaque glyphs unless they go on a highlite
 
-                if self.search_term in _entry and idx_x < 2:
+                if self.search_term and idx_x < 2 and self.search_term in lower[idx_x]:
+                    _entry = lower[idx_x]
                     term_rect = pygame.Rect(
-                        pos[0] + Font.medium.size(_entry[:_entry.find(self.search_term)])[0],
+                        pos[0] + _entry.find(self.search_term) * font_size[0],
                         pos[1],
-                        Font.medium.size(self.search_term)[0],
+                        len(self.search_term) * font_size[0],
                         cell_size_y
                     )
                     
                     if term_rect.left - idx_x*cell_size_x < cell_size_x:
                         pygame.draw.rect(self.surface, Colors.table_highlite_word, term_rect, 0, 5)
                         pygame.draw.rect(self.surface, Colors.table_highlite_colum, term_rect, 1, 5)
-                text = Font.medium.render(entry,True,Colors.text_light)
-                rect = pygame.Rect((0,0), (cell_size_x, cell_size_y))
-                self.surface.blit(text,pos,rect)
+                        background = None
+                glyphs += GLYPHS.layout(Font.medium, entry, Colors.text_light, pos, cell_size_x, background)
+        self.surface.fblits(glyphs)
 
         if self.hover:
             txt, rect, idx = self.translate(self.hover) # type: ignore
@@ -429,9 +538,10 @@ class Table:
         font_size = Font.medium.size('a')
         idx_x = int((global_pos[0]-self.rect.x) / (self.rect.width/3))
         idx_y = int((global_pos[1] - self.rect.y + self.scroll_pos) / font_size[1])
+        row = self.row_at(idx_y)
         
-        if all((0 <= idx_x < 3, 0 <= idx_y < len(self.content))):
-            text = self.content[idx_y][idx_x]
+        if all((0 <= idx_x < 3, 0 <= row < len(self.content))):
+            text = self.content.get(row, idx_x)
         else:
             text = None
 
@@ -442,35 +552,86 @@ class Table:
             font_size[1]
         )
 
-        index = idx_y, idx_x
+        index = row, idx_x
 
         return text, rect, index
 
+    def row_count(self):
+        return len(self.content) if self.view is None else len(self.view)
+
+    def row_at(self, idx_y:int):
+        """content row shown at screen row idx_y, below the last one it's the row a new entry would get"""
+        if self.view is None or idx_y < 0:
+            return idx_y
+        if idx_y < len(self.view):
+            return self.view[idx_y]
+        return len(self.content) + idx_y - len(self.view)
+
+    def mask(self, password:str):
+        """the stars drawn for a password, a sealed one knows its length without being opened"""
+        return '*' * (self.fields.length(password) if self.fields and password else len(password))
+
+    def reveal(self, row:int, column:int):
+        """plaintext of a cell, the only place a sealed password gets opened. None past the last row"""
+        if not 0 <= row < len(self.content):
+            return None
+        text = self.content.get(row, column)
+        return self.fields.open(text) if column == 2 and self.fields and text else text
+
+    def mark(self, rect:pygame.Rect|None = None):
+        """flags part of the table (all of it by default) for the next update"""
+        self.dirty_rects.append(pygame.Rect(rect) if rect else self.surface.get_rect())
+
+    def hover_row(self):
+        """area of the highlite lines around the hovered row"""
+        if not self.hover:
+            return None
+        _, rect, _ = self.translate(self.hover) # type: ignore
+        return pygame.Rect(0, rect.top - 1, self.rect.width, rect.height + 2)
+
+    def set_cell(self, idx_y:int, idx_x:int, text:str):
+        self.content.set(idx_y, idx_x, self.fields.seal(text) if idx_x == 2 and self.fields and text else text)
+        self.edited_rows.add(idx_y)
+        self.index.update(idx_y, self.content[idx_y])
+
     def handle_event(self, event:pygame.Event):
         events = []
 
         if self.tmp_txt:
             for e in self.tmp_txt.handle_event(event):
-                if e == 'textfield_return':
+                if e == 'draw':
+                    self.mark(self.tmp_txt.rect)
+                elif e == 'textfield_return':
                     if self.tmp_txt_index[0] >= len(self.content): # make new entry
                         newline = ['','','']
                         newline[self.tmp_txt_index[1]] = self.tmp_txt.text
+                        if self.tmp_txt_index[1] == 2 and self.fields and newline[2]:
+                            newline[2] = self.fields.seal(newline[2])
                         self.content.append(newline)
+                        self.edited_rows.add(len(self.content)-1)
+                        self.index.update(len(self.content)-1, newline)
+                        if self.view is not None: # keep showing it, even if it doesn't match the search
+                            self.view.append(len(self.content)-1)
                     else: # update existing entry
-                        self.content[self.tmp_txt_index[0]][self.tmp_txt_index[1]] = self.tmp_txt.text if self.tmp_txt.text else self.tmp_txt.text_default
+                        self.set_cell(*self.tmp_txt_index, self.tmp_txt.text if self.tmp_txt.text else self.tmp_txt.text_default)
                 
                     self.tmp_txt = None
                     self.tmp_txt_index = None
+                    self.mark()
                     events.append('update_file')
 
         if event.type == pygame.MOUSEMOTION:
+            old_row = self.hover_row()
             if self.rect.collidepoint(event.pos):
                 self.hover = event.pos
             else:
                 self.hover = False
 
-            if self.hover:
-                self.draw()
+            new_row = self.hover_row()
+            if old_row != new_row: # moving inside a row changes nothing
+                for rect in (old_row, new_row):
+                    if rect:
+                        self.mark(rect)
                 events.append('draw')
 
         elif event.type == pygame.MOUSEWHEEL:
@@ -480,46 +641,48 @@ class Table:
 
         elif event.type == pygame.MOUSEBUTTONDOWN and self.hover and self.velocity==0:
             if event.button == 1: # left mouse button
-                txt, rect, idx = self.translate(event.pos)
+                _, rect, idx = self.translate(event.pos)
+                txt = self.reveal(*idx)
                 rect.move_ip(-Size.padding,0)
-                self.tmp_txt = TextField(rect, txt, True, False, True)
+                self.tmp_txt = TextField(rect, txt, True, False, True, cache_text=False)
                 self.tmp_txt_index = idx
+                self.mark(rect)
 
             if event.button == 3: # right mouse button
-                txt, rect, idx = self.translate(event.pos)
+                _, rect, idx = self.translate(event.pos)
+                txt = self.reveal(*idx)
                 pygame.scrap.put_text(txt)
                 print('copied to clipboard')
 
         elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_TAB and self.tmp_txt:
-                self.content[self.tmp_txt_index[0]][self.tmp_txt_index[1]] = self.tmp_txt.text if self.tmp_txt.text else self.tmp_txt.text_default
+                self.set_cell(*self.tmp_txt_index, self.tmp_txt.text if self.tmp_txt.text else self.tmp_txt.text_default)
                 self.tmp_txt_index = self.tmp_txt_index[0], (self.tmp_txt_index[1]+1) % 3
                 #print(self.tmp_txt_index)
-                txt = self.content[self.tmp_txt_index[0]][self.tmp_txt_index[1]]
+                txt = self.reveal(*self.tmp_txt_index)
                 rect = self.tmp_txt.rect
                 rect.x = int(self.rect.width / 3 * self.tmp_txt_index[1]) - Size.padding
-                self.tmp_txt = TextField(rect, txt, True, False, True)
-                #self.draw()
+                self.tmp_txt = TextField(rect, txt, True, False, True, cache_text=False)
+                self.mark()
                 events.append('update_file')
 
         return events
     
-    def scroll_to_search(self):
-        index = None
-        for idx_y, line in enumerate(self.content):
-            for entry in line:
-                if self.search_term in entry:
-                    index = idx_y
-                    break
-            if index: break
-
-        font_height = Font.medium.size('a')[1]
-        self.scroll_pos = index * font_height
+    def set_search(self, search_term:str):
+        """shows only the rows matching search_term, ranked, edits still go to the original rows"""
+        self.search_term = search_term
+        self.view = self.index.rank(search_term, self.view_limit) if search_term else None
+        self.scroll_pos = 0
+        self.tmp_txt = None
+        self.tmp_txt_index = None
+        self.mark()
 
     def update(self):
+        if self.velocity:
+            self.mark()
         self.scroll_pos += self.velocity
         self.velocity *= .9
         if abs(self.velocity) <= 0.01: self.velocity = 0
-        self.scroll_pos = min(max(0, self.scroll_pos), (len(self.content)+1)*Font.medium.size('a')[1] - self.rect.height)
+        self.scroll_pos = max(0, min(self.scroll_pos, (self.row_count()+1)*Font.medium.size('a')[1] - self.rect.height))
         self.draw()
 